@@ -0,0 +1,201 @@
+"""HTTP inference API on top of the same models and preprocessing as the app.
+
+    uvicorn api_server:app --host 0.0.0.0 --port 8000
+
+    curl --data-binary @scan.jpg 'localhost:8000/classify?model=cnn'
+    curl -F file=@scan.jpg localhost:8000/saliency -o saliency.png
+    curl -F file=@scan.jpg 'localhost:8000/saliency?method=gradcam' -o gradcam.png
+    curl -F file=@scan.jpg 'localhost:8000/report?llm=gemini-1.5-flash' -o report.pdf
+
+Images are accepted as multipart form data or as the raw request body. Model
+work runs in a bounded thread pool off the event loop; once MAX_PENDING
+requests are queued or running, new ones get 503 with Retry-After.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import PIL.Image
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response
+
+import llm_client
+from audit_store import get_audit_store
+from llm_providers import configure
+from metrics import METRICS
+from model_registry import MODELS
+from pipeline import Pipeline, encode_png, summarize
+from report import create_pdf_report
+from result_cache import ResultCache
+from saliency import INPUT_GRADIENTS, METHODS
+
+WORKERS = int(os.getenv("API_WORKERS", os.cpu_count() or 4))
+MAX_PENDING = int(os.getenv("API_MAX_PENDING", WORKERS * 4))
+MAX_UPLOAD_BYTES = int(os.getenv("API_MAX_UPLOAD_BYTES", 20 * 1024 * 1024))
+UPLOAD_CHUNK_BYTES = 64 * 1024
+
+EXPLAINERS = {
+    "gemini-1.5-flash": llm_client.generate_explanation_gemini,
+    "pixtral-12b-2409": llm_client.generate_explanation_pixtral,
+}
+
+configure(google_api_key=os.getenv("GOOGLE_API_KEY"), pixtral_api_key=os.getenv("PIXTRAL_API_KEY"))
+
+app = FastAPI(title="Brain Tumor Classification")
+pipeline = Pipeline(cache=ResultCache(disk_dir=os.getenv("RESULT_CACHE_DIR")),
+                    backend=os.getenv("INFERENCE_BACKEND", "keras"), audit=get_audit_store())
+executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="api-worker")
+pending = 0
+
+
+async def run_in_pool(fn, *args):
+    # Backpressure: refuse work the pool could not start soon rather than
+    # letting requests pile up behind it.
+    global pending
+    if pending >= MAX_PENDING:
+        METRICS.inc('api_rejected_total')
+        raise HTTPException(503, "Server busy, retry shortly", headers={"Retry-After": "1"})
+    pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+    finally:
+        pending -= 1
+
+
+async def _read_limited(chunks):
+    # Joins the chunks, giving up with 413 as soon as they pass the limit
+    # rather than holding an oversized body in memory first.
+    data = bytearray()
+    async for chunk in chunks:
+        data += chunk
+        if len(data) > MAX_UPLOAD_BYTES:
+            raise HTTPException(413, "Image too large")
+    return bytes(data)
+
+
+async def _upload_chunks(upload):
+    while chunk := await upload.read(UPLOAD_CHUNK_BYTES):
+        yield chunk
+
+
+async def read_image(request):
+    # A declared length over the limit is refused before anything is read;
+    # chunked or understated bodies are cut off while reading.
+    try:
+        declared = int(request.headers.get("content-length", 0))
+    except ValueError:
+        raise HTTPException(400, "Invalid Content-Length")
+    if declared > MAX_UPLOAD_BYTES:
+        raise HTTPException(413, "Image too large")
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file") or next((value for value in form.values() if hasattr(value, "read")), None)
+        if upload is None:
+            raise HTTPException(400, "Expected an image in the 'file' form field")
+        data = await _read_limited(_upload_chunks(upload))
+    else:
+        data = await _read_limited(request.stream())
+    if not data:
+        raise HTTPException(400, "Empty image")
+    return data
+
+
+async def _value(value):
+    return value
+
+
+def model_name(model):
+    if model not in MODELS:
+        raise HTTPException(400, f"Unknown model {model!r}, expected one of {sorted(MODELS)}")
+    return MODELS[model]
+
+
+def saliency_method(method):
+    if method not in METHODS:
+        raise HTTPException(400, f"Unknown saliency method {method!r}, expected one of {sorted(METHODS)}")
+    return method
+
+
+@app.exception_handler(PIL.UnidentifiedImageError)
+async def undecodable_image(request, exc):
+    return JSONResponse({"detail": "Could not decode image"}, status_code=400)
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok", "pending": pending, "max_pending": MAX_PENDING}
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(METRICS.prometheus_text(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/classify")
+async def classify(request: Request, model: str = "xception"):
+    name = model_name(model)
+    image_bytes = await read_image(request)
+    with METRICS.timer('api_request_seconds', endpoint='classify'):
+        probabilities = await run_in_pool(pipeline.classify, image_bytes, name)
+    return {"model": name, **summarize(probabilities)}
+
+
+@app.post("/saliency")
+async def saliency(request: Request, model: str = "xception", method: str = INPUT_GRADIENTS):
+    name = model_name(model)
+    method = saliency_method(method)
+    image_bytes = await read_image(request)
+    with METRICS.timer('api_request_seconds', endpoint='saliency'):
+        probabilities, saliency_map = await run_in_pool(pipeline.saliency, image_bytes, name, method)
+        png = await run_in_pool(encode_png, saliency_map)
+    summary = summarize(probabilities)
+    return Response(png, media_type="image/png", headers={
+        "X-Predicted-Class": summary["label"],
+        "X-Confidence": f"{summary['confidence']:.6f}",
+    })
+
+
+@app.post("/report")
+async def report(request: Request, model: str = "xception", llm: str = "gemini-1.5-flash",
+                 method: str = INPUT_GRADIENTS):
+    name = model_name(model)
+    method = saliency_method(method)
+    if llm not in EXPLAINERS:
+        raise HTTPException(400, f"Unknown llm {llm!r}, expected one of {sorted(EXPLAINERS)}")
+    image_bytes = await read_image(request)
+
+    with METRICS.timer('api_request_seconds', endpoint='report'):
+        key = pipeline.cache_key(image_bytes, name, method)
+        cached = pipeline.cache.get(key) or {}
+        if llm not in cached.get('reports', {}):
+            probabilities, saliency_map = await run_in_pool(pipeline.saliency, image_bytes, name, method)
+            summary = summarize(probabilities)
+            cached = pipeline.cache.get(key) or {}
+            explanations = cached.get('explanations', {})
+
+            # The similar-case lookup runs in the pool while the LLM explains.
+            if llm in explanations:
+                explanation_call = asyncio.wrap_future(llm_client.submit(_value(explanations[llm])))
+            else:
+                explanation_call = asyncio.wrap_future(llm_client.submit(EXPLAINERS[llm](
+                    PIL.Image.fromarray(saliency_map), summary["label"], summary["confidence"])))
+            explanation, cases = await asyncio.gather(explanation_call,
+                                                      run_in_pool(pipeline.similar_cases, image_bytes, name))
+
+            pdf = await run_in_pool(create_pdf_report, probabilities, summary["confidence"], summary["label"],
+                                    saliency_map, explanation, cases)
+            cached = pipeline.cache.update(key, explanations={**explanations, llm: explanation},
+                                           reports={**cached.get('reports', {}), llm: pdf})
+
+    return Response(cached['reports'][llm], media_type="application/pdf",
+                    headers={"Content-Disposition": 'attachment; filename="Brain_Tumor_Classification_Report.pdf"'})
+
+
+def main():
+    import uvicorn
+
+    uvicorn.run(app, host=os.getenv("API_HOST", "0.0.0.0"), port=int(os.getenv("API_PORT", 8000)))
+
+
+if __name__ == '__main__':
+    main()
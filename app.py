@@ -1,365 +1,195 @@
-import streamlit as st
-import plotly.graph_objects as go
-import tensorflow as tf
-from tensorflow.keras.models import load_model
-from tensorflow.keras.preprocessing import image
-import numpy as np
-import plotly.graph_objects as go
-import cv2
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Dense, Dropout, Flatten
-from tensorflow.keras.optimizers import Adamax
-from tensorflow.keras.metrics import Precision, Recall
-import google.generativeai as genai
+import concurrent.futures
 import os
-
-from mistralai import Mistral
-import PIL.Image
-from fpdf import FPDF
+import threading
 import time
-import datetime
-import random
-
-api_key = st.secrets["GOOGLE_API_KEY"]
-genai.configure(api_key=api_key)
-
-output_dir = 'saliency_map'
-os.makedirs(output_dir, exist_ok=True)
-
-def create_pdf_report(prediction, confidence, result, saliency_map_path):
-    class PDF(FPDF):
-        def header(self):
-            self.set_font("Arial", "B", 12)
-            self.cell(0, 10, "Brain Tumor Classification App", align="C", ln=True)
-
-        def footer(self):
-            self.set_y(-15)
-            self.set_font("Arial", "I", 8)
-            self.cell(0, 10, f"Made by Dawit Zewdu @ December 2024", align="C")
-
-    pdf = PDF()
-    pdf.set_auto_page_break(auto=True, margin=15)
-    pdf.add_page()
-
-    # Title
-    pdf.set_font("Arial", "B", 16)
-    pdf.cell(0, 10, "Brain Tumor Classification Report", ln=True, align="C")
-    pdf.ln(10)
-
-    # Add Prediction Summary
-    pdf.set_font("Arial", size=12)
-    pdf.cell(0, 10, f"Date: {datetime.datetime.now().strftime('%Y-%m-%d')}", ln=True)
-    pdf.cell(0, 10, f"Predicted Class: {result}", ln=True)
-    pdf.cell(0, 10, f"Confidence: {confidence * 100:.2f}%", ln=True)
-    pdf.ln(10)
-
-    # Add Saliency Map
-    pdf.set_font("Arial", "B", 12)
-    pdf.cell(0, 10, "Saliency Map:", ln=True)
-    pdf.image(saliency_map_path, x=50, y=None, w=100)  # Adjust size and positioning
-    pdf.ln(10)
-
-    # Explanation Section
-    pdf.set_font("Arial", "B", 12)
-    pdf.cell(0, 10, "Explanation:", ln=True)
-    pdf.set_font("Arial", size=12)
-    pdf.multi_cell(0, 10, txt=explanation)
-    pdf.ln(10)
-
-    # Add Previous History Cases (Simulated AI-generated examples)
-    pdf.set_font("Arial", "B", 12)
-    pdf.cell(0, 10, "Previous History Cases:", ln=True)
-    pdf.set_font("Arial", size=12)
-    ex1 = generate_mock_case(prediction, confidence)
-    ex2 = generate_mock_case(prediction, confidence)
-    ex3 = generate_mock_case(prediction, confidence)
-    cases = [
-        ex1
-    ]
-    for case in cases:
-        pdf.multi_cell(0, 10, txt=case)
-        pdf.ln(10)
-
-    # General Recommendations Section
-    pdf.set_font("Arial", "B", 12)
-    pdf.cell(0, 10, "General Recommendations:", ln=True)
-    pdf.set_font("Arial", size=12)
-    recommendations = (
-        "1. Consult a neurologist or medical professional for confirmation.\n"
-        "2. Bring this report to your doctor's appointment for a more informed discussion.\n"
-        "3. Follow your doctor's advice for further diagnostic tests or treatment options.\n"
-        "4. Maintain a healthy lifestyle, including regular check-ups, to monitor your brain health."
-    )
-    pdf.multi_cell(0, 10, txt=recommendations)
-    pdf.ln(10)
-
-    # Disclaimer Section
-    pdf.set_font("Arial", "B", 12)
-    pdf.cell(0, 10, "Cautionary Disclaimer:", ln=True)
-    pdf.set_font("Arial", size=12)
-    disclaimer = (
-        "This report is generated for informational purposes only and must not replace a doctor's consultation. "
-        "The predictions made by this app are based on a deep learning model and should not be considered a definitive diagnosis. "
-        "We strongly recommend consulting a qualified medical professional for confirmation and further guidance."
-        "The previous cases that are listed here are simulated using AI, please understand that those are not real cases."
-    )
-    pdf.multi_cell(0, 10, txt=disclaimer)
-    pdf.ln(10)
-
-    # Save PDF to a temporary file
-    report_path = os.path.join(output_dir, 'report.pdf')
-    pdf.output(report_path)
-    return report_path
-
-
-
-def generate_mock_case(model_prediction, confidence):
-    prompt = f"""
-    Generate a mock history case (cases that happened before) based on the AI prediction and patient information:
-        model_prediction (str): The predicted class from the model -> {model_prediction}.
-        confidence (float): The confidence level of the prediction -> {confidence * 100:.2f}
-
-    Return a single-line realistic mock case description based on the inputed information.
-
-    Here are some examples of mock cases:
-      if {model_prediction} == 'glioma':
-        "Example 1: Glioma detected with {confidence * 100:.2f}% confidence. Patient exhibited early-stage symptoms and responded well to treatment."
-      elif {model_prediction} == 'meningioma':
-        "Example 2: Meningioma detected with {confidence * 100:.2f}% confidence. MRI indicated abnormal growth in the frontal lobe."
-      elif {model_prediction} == 'pituitary':
-        "Example 4: Pituitary tumor detected with {confidence * 100:.2f}% confidence. Patient underwent surgery and showed improvement post-treatment."
-      else:
-        "Example 3: No tumor detected. MRI confirmed no significant abnormalities."
-
-    """
-
-
-    model = genai.GenerativeModel(model_name="gemini-1.5-flash")
-    response = model.generate_content([prompt], stream=False)
-
-    return response.text
-
-
-def generate_explanation_gemini(img_path, model_prediction, confidence):
-
-    prompt = f"""You are an expert neurologist. You are tasked with explaining a saliency map of a brain tumor MRI scan.
-    The saliency map was generated by a deep learning model that was trained to classify brain tumors
-    as either glioma, meningioma, pituitary, or no tumor.
-
-    The saliency map highlights the regions of the image that the machine learning model is focusing on to make the prediction.
-
-    The deep learning model predicted the image to be of class '{model_prediction}' with a confidence of {confidence * 100}%.
-
-    In your response:
-    – Explain what regions of the brain the model is focusing on, based on the saliency map. Refer to the regions highlighted
-    in light cyan, those are the regions where the model is focusing on.
-    – Explain possible reasons why the model made the prediction it did.
-    – Don’t mention anything like "The saliency map highlights the regions the model is focusing on, which are in light cyan"
-    in your explanation.
-    – Keep your explanation to 4 sentences max.
-
-    Let's think step by step about this. Verify step by step.
-    """
-
-    img = PIL.Image.open(img_path)
-
-    model = genai.GenerativeModel(model_name="gemini-1.5-flash")
-    response = model.generate_content([prompt, img])
-
-    return response.text
-
-def generate_explanation_pixtral(img_path, model_prediction, confidence):
-
-  prompt = f"""You are an expert neurologist. You are tasked with explaining a saliency map of a brain tumor MRI scan.
-    The saliency map was generated by a deep learning model that was trained to classify brain tumors
-    as either glioma, meningioma, pituitary, or no tumor.
-
-    The saliency map highlights the regions of the image that the machine learning model is focusing on to make the prediction.
-
-    The deep learning model predicted the image to be of class '{model_prediction}' with a confidence of {confidence * 100}%.
-
-    In your response:
-    – Explain what regions of the brain the model is focusing on, based on the saliency map. Refer to the regions highlighted
-    in light cyan, those are the regions where the model is focusing on.
-    – Explain possible reasons why the model made the prediction it did.
-    – Don’t mention anything like "The saliency map highlights the regions the model is focusing on, which are in light cyan"
-    in your explanation.
-    – Keep your explanation to 4 sentences max.
-
-    Let's think step by step about this. Verify step by step.
-    """
-
-  api_key = st.secrets["PIXTRAL_API_KEY"]
-  img = PIL.Image.open(img_path)
-
-  model = "pixtral-12b-2409"
-
-  client = Mistral(api_key=api_key)
-
-  chat_response = client.chat.complete(
-      model= model,
-      messages = [
-          {
-              "role": "user",
-              "content": prompt,
-          },
-      ]
-  )
-
-  response = chat_response.choices[0].message.content
-
-
-  return response
-
-
-# Chat
-def generate_chat_response_gemini(user_question, user_type, model_prediction, confidence, img_path):
-  prompt = f"""You are an expert neurologist specializing in brain tumors. You have been asked to interpret and explain the results of an MRI scan.
-  The scan was classified by a deep learning model as one of four categories: glioma, meningioma, pituitary tumor, or no tumor.
-  The model predicts this MRI scan to be of class '{model_prediction}' with a confidence level of {confidence * 100}%.
-
-  The user is a {user_type} and has asked the following question: {user_question}.
-
-  When responding, keep the following in mind:
 
-  If the user is a patient, avoid medical jargon and provide an explanation that is clear and accessible to someone with no medical background. Keep it simple and reassuring.
-  Do not adopt a formal doctor's role; just provide information based on the question without suggesting appointments, further steps, or treatment options.
-  Use a step-by-step approach in your response to ensure clarity and thoroughness.
-  Be brief in your responses.
-
-  Let's think step by step about this. Verify step by step.
-
-  """
-  img = PIL.Image.open(img_path)
+import numpy as np
+import PIL.Image
+import streamlit as st
 
-  model = genai.GenerativeModel(model_name="gemini-1.5-flash")
-  response = model.generate_content([prompt, img], stream=True)
+import llm_client
+import metrics
+from audit_store import get_audit_store
+from llm_providers import configure
+from metrics import METRICS
+from result_cache import ResultCache, make_cache_key
 
-  for chunk in response:
-    yield chunk.text
+# TensorFlow, the models, OpenCV, Plotly and fpdf are imported where they are
+# first needed, below the page shell: a cold start draws the title and the
+# uploader without waiting for them.
 
+st.set_page_config(
+    page_title="Brain Tumor Classification",
+    page_icon="🧠",
+    layout="wide",
+    initial_sidebar_state="expanded")
 
+st.title('Brain Tumor Classification')
 
+col = st.columns((1.5, 4.5, 2), gap='medium')
 
-def generate_saliency_map(model, img_array, class_index, img_size):
-    with tf.GradientTape() as tape:
-        img_tensor = tf.convert_to_tensor(img_array)
-        tape.watch(img_tensor)
-        predictions = model(img_tensor)
-        target_class = predictions[:, class_index]
+with col[1]:
+  st.write("Upload an image of a brain MRI scan to classify.")
+  uploaded_file = st.file_uploader("Choose an image...", type=["jpg", "jpeg", "png"])
+  with st.expander("Or classify a whole study (DICOM series or NIfTI volume)"):
+    # DICOM files often have no extension, so any file is accepted here.
+    study_files = st.file_uploader("Choose the study's files...", accept_multiple_files=True, key='study_files')
+
+
+def read_secret(name):
+  # Secrets are optional so the app also runs offline with LLM_PROVIDER=local.
+  try:
+    return st.secrets.get(name) or os.getenv(name)
+  except FileNotFoundError:
+    return os.getenv(name)
+
+
+# Only records the keys; the Gemini and Mistral clients are created on the
+# first call that needs them.
+configure(google_api_key=read_secret("GOOGLE_API_KEY"), pixtral_api_key=read_secret("PIXTRAL_API_KEY"))
+
+inference_backend = os.getenv("INFERENCE_BACKEND", "keras")
 
-    gradients = tape.gradient(target_class, img_tensor)
-    gradients = tf.math.abs(gradients)
-    gradients = tf.reduce_max(gradients, axis=-1)
-    gradients = gradients.numpy().squeeze()
+def llm_task(group, key, coro_factory):
+  # One in-flight request per group. Changing the selection that a request
+  # was started for cancels it instead of letting it run to completion.
+  tasks = st.session_state.setdefault('llm_tasks', {})
+  task = tasks.get(group)
+  if task is not None and task[0] != key:
+    task[1].cancel()
+    task = None
+  if task is None:
+    task = tasks[group] = (key, llm_client.submit(coro_factory()))
+  return task[1]
 
-    gradients = cv2.resize(gradients, img_size)
 
-    center = (gradients.shape[0] // 2, gradients.shape[1] // 2)
-    radius = min(center[0], center[1]) - 10
-    y, x = np.ogrid[:gradients.shape[0], :gradients.shape[1]]
-    mask = (x - center[0])** 2 + (y - center[1])** 2 <= radius**2
+def cancel_llm_task(group):
+  task = st.session_state.get('llm_tasks', {}).pop(group, None)
+  if task is not None:
+    task[1].cancel()
 
-    gradients = gradients * mask
 
-    brain_gradients = gradients[mask]
-    if brain_gradients.max() > brain_gradients.min():
-        brain_gradients = (brain_gradients - brain_gradients.min()) / (brain_gradients.max() - brain_gradients.min())
-    gradients[mask] = brain_gradients
+def llm_result(group, key, coro_factory, poll_interval=0.25):
+  # Waits in short polls with an st call between them: Streamlit can only
+  # stop a run for a rerun inside st calls, so a plain future.result() would
+  # hold the rerun until the request finished.
+  future = llm_task(group, key, coro_factory)
+  interrupted = st.session_state.setdefault('llm_interrupted', set())
+  interrupted.add(group)
+  status = st.empty()
+  start = time.perf_counter()
+  try:
+    while True:
+      try:
+        return future.result(timeout=poll_interval)
+      except concurrent.futures.TimeoutError:
+        status.caption(f"Waiting for the response... {time.perf_counter() - start:.0f}s")
+  finally:
+    status.empty()
+    if future.done():
+      st.session_state.llm_tasks.pop(group, None)
+      interrupted.discard(group)
 
-    # Apply a higher threshold
-    threshold = np.percentile(gradients[mask], 80)
-    gradients[gradients < threshold] = 0
 
-    # Apply more aggressive smoothing
-    gradients = cv2.GaussianBlur(gradients, (11, 11), 0)
+def close_chat():
+  # The replaced session's upload is deleted in the background; the rerun
+  # does not wait for it.
+  chat = st.session_state.pop('chat', None)
+  if chat is not None:
+    llm_client.submit(chat.close())
 
-    # Create a heatmap overlay with enhanced contrast
-    heatmap = cv2.applyColorMap(np.uint8(255 * gradients), cv2.COLORMAP_JET)
-    heatmap = cv2.cvtColor(heatmap, cv2.COLOR_BGR2RGB)
 
-    # Resize heatmap to match original image size
-    heatmap = cv2.resize(heatmap, img_size)
+def cancel_interrupted_llm_tasks():
+  # A rerun that stopped llm_result mid-wait leaves its request running with
+  # nobody to read it; it is cancelled as the next run starts.
+  for group in st.session_state.pop('llm_interrupted', set()):
+    cancel_llm_task(group)
 
-    # Superimpose the heatmap on original image with increased opacity
-    original_img = image.img_to_array(img)
-    superimposed_img = heatmap * 0.7 + original_img * 0.3
-    superimposed_img = superimposed_img.astype(np.uint8)
 
-    img_path = os.path.join(output_dir, uploaded_file.name)
-    with open(img_path, 'wb') as f:
-      f.write(uploaded_file.getbuffer())
+cancel_interrupted_llm_tasks()
+if uploaded_file is None:
+  close_chat()
 
-    saliency_map_path = f'saliency_map/{uploaded_file.name}'
 
-    # save the saliency map
-    cv2.imwrite(saliency_map_path, cv2.cvtColor(superimposed_img, cv2.COLOR_RGB2BGR))
+@st.cache_resource
+def start_warmup():
+  # Imports TensorFlow and loads the models in the background once the
+  # shell is on screen, so the first upload usually finds them ready.
+  def warm():
+    from model_registry import get_registry
+    get_registry().warm()
 
-    return superimposed_img
+  thread = threading.Thread(target=warm, name="warmup", daemon=True)
+  thread.start()
+  return thread
 
 
-def load_xception_model(path):
-  img_shape = (299, 299, 3)
-  base_model = tf.keras.applications.Xception(include_top=False, weights="imagenet", input_shape=img_shape, pooling='max')
+@st.cache_resource
+def get_model_registry():
+  from model_registry import get_registry
+  return get_registry()
 
-  model = Sequential([
-      base_model,
-      Flatten(),
-      Dropout(rate=0.3),
-      Dense(128, activation='relu'),
-      Dropout(rate=0.25),
-      Dense(4, activation='softmax')
-  ])
 
-  model.build((None,) + img_shape)
+@st.cache_resource
+def get_result_cache():
+  return ResultCache(disk_dir=os.getenv("RESULT_CACHE_DIR"))
 
-  model.compile(Adamax(learning_rate=0.01),
-                loss="categorical_crossentropy",
-                metrics=['accuracy', Precision(), Recall()])
-  model.load_weights(path)
 
-  return model
+@st.cache_resource
+def get_pipeline():
+  from pipeline import Pipeline
+  return Pipeline(cache=get_result_cache(), backend=inference_backend, registry=get_model_registry(),
+                  audit=get_audit_store(), source='app')
 
 
-st.set_page_config(
-    page_title="Brain Tumor Classification",
-    page_icon="🧠",
-    layout="wide",
-    initial_sidebar_state="expanded")
+@st.cache_resource
+def start_metrics_server():
+  # Prometheus scrapes /metrics; /metrics.json and /traces are for humans.
+  port = os.getenv("METRICS_PORT")
+  return metrics.serve(int(port)) if port else None
 
-st.title('Brain Tumor Classification')
 
-col = st.columns((1.5, 4.5, 2), gap='medium')
+start_metrics_server()
+start_warmup()
 
 
 with col[1]:
-  st.write("Upload an image of a brain MRI scan to classify.")
-  uploaded_file = st.file_uploader("Choose an image...", type=["jpg", "jpeg", "png"])
-
-
   if uploaded_file is not None:
+      from model_registry import CUSTOM_CNN, LABELS, XCEPTION
+      from ensemble import ENSEMBLE, Ensemble
+      from saliency import METHODS
+
       selected_model = st.radio(
           "Select a model:",
-          ("Transfer Learning - Xception", "Custom CNN")
+          ("Transfer Learning - Xception", "Custom CNN", ENSEMBLE)
       )
-
-      if selected_model == "Transfer Learning - Xception":
-        with st.spinner('Generating prediction...'):
-          model = load_xception_model('trained_xception_model.weights.h5')
-          img_size = (299, 299)
+      saliency_method = st.radio("Saliency method:", list(METHODS), format_func=METHODS.get, horizontal=True)
+
+      trace_token = METRICS.start_trace('upload', model=selected_model)
+      registry = get_model_registry()
+      pipeline = get_pipeline()
+      if selected_model == ENSEMBLE:
+        xception_weight = st.slider("Xception weight in the ensemble", 0.0, 1.0, 0.5, 0.05)
+        # The saliency map explains the ensemble's class through Xception.
+        model = Ensemble(weights={XCEPTION: xception_weight, CUSTOM_CNN: 1.0 - xception_weight},
+                         backend=inference_backend, registry=registry)
       else:
-        with st.spinner('Generating prediction...'):
-          model = load_model('trained_cnn_model.h5')
-          img_size = (224, 224)
-
-
-      labels = ['Glioma', 'Meningioma', 'No tumor', 'Pituitary']
-      img = image.load_img(uploaded_file, target_size=img_size)
-      img_array = image.img_to_array(img)
-      img_array = np.expand_dims(img_array, axis=0)
-      img_array /= 255.0
-
-      prediction = model.predict(img_array)
+        model = selected_model
+      labels = LABELS
+
+      # Everything is computed through the same Pipeline as the HTTP API and
+      # cached under the same keys, so reruns triggered by other widgets reuse
+      # it instead of decoding and classifying the scan again. Explanations,
+      # reports and the chat refer to the map, so they are cached under the
+      # saliency method's key.
+      image_bytes = uploaded_file.getvalue()
+      cache_key = pipeline.cache_key(image_bytes, model, saliency_method)
+      result_cache = pipeline.cache
+      with st.spinner('Generating prediction...'):
+        probabilities, saliency_map = pipeline.saliency(image_bytes, model, saliency_method)
+      scan = pipeline.entry(image_bytes, model)
+      cached = result_cache.get(cache_key) or {}
+      prediction = probabilities[np.newaxis]
 
       # Get the class with the highest probability
       class_index = np.argmax(prediction[0])
@@ -367,6 +197,8 @@ with col[1]:
 
 with col[0]:
   if uploaded_file is not None:
+    import plotly.graph_objects as go
+
     # Assuming prediction and labels are already defined
     probabilities = prediction[0]
     sorted_indices = np.argsort(probabilities)[::-1]
@@ -416,15 +248,14 @@ with col[0]:
 
 with col[1]:
   if uploaded_file is not None:
-    # Generate the saliency map
-    saliency_map = generate_saliency_map(model, img_array, class_index, img_size)
+    saliency_image = PIL.Image.fromarray(saliency_map)
 
     # Display the two images side by side
     col1, col2 = st.columns(2)
     with col1:
-      st.image(uploaded_file, caption="Uploaded Image", use_container_width=True)
+      st.image(scan['image'], caption="Uploaded Image", use_container_width=True)
     with col2:
-      st.image(saliency_map, caption="Saliency Map", use_container_width=True)
+      st.image(saliency_map, caption=f"Saliency Map ({METHODS[saliency_method]})", use_container_width=True)
 
     result_container = st.container()
     result_container = st.container()
@@ -453,6 +284,19 @@ with col[1]:
       unsafe_allow_html=True
     )
 
+    if 'per_model' in scan:
+      # Ensemble mode: what each member said, next to the combined answer.
+      per_model = scan['per_model']
+      st.dataframe([
+        {'model': name, 'prediction': labels[int(np.argmax(probs[0]))],
+         **{label: f"{p * 100:.2f}%" for label, p in zip(labels, probs[0])}}
+        for name, probs in per_model.items()
+      ], hide_index=True)
+      if scan['agree'][0]:
+        st.caption("Both models predict the same class.")
+      else:
+        st.caption("The models disagree; the prediction above is their weighted average.")
+
 
 
 with col[2]:
@@ -460,21 +304,31 @@ with col[2]:
 
     # Explanation
     st.write("## Explanation")
-    saliency_map_path = f'saliency_map/{uploaded_file.name}'
 
     llm_model_for_exp = st.radio("Select a model to explain the images to you:", ("Please select...", "gemini-1.5-flash", "pixtral-12b-2409"))
-    if llm_model_for_exp == "gemini-1.5-flash":
-      with st.spinner('Generating explantion...'):
-        explanation = generate_explanation_gemini(saliency_map_path, result, prediction[0][class_index])
-        st.write(explanation)
-    elif llm_model_for_exp == "pixtral-12b-2409":
+    explanations = cached.get('explanations', {})
+    reports = cached.get('reports', {})
+    explainers = {
+      "gemini-1.5-flash": llm_client.generate_explanation_gemini,
+      "pixtral-12b-2409": llm_client.generate_explanation_pixtral,
+    }
+
+    if llm_model_for_exp in explanations:
+      explanation = explanations[llm_model_for_exp]
+      st.write(explanation)
+    elif llm_model_for_exp in explainers:
       with st.spinner('Generating explantion...'):
-        explanation = generate_explanation_pixtral(saliency_map_path, result, prediction[0][class_index])
+        explanation = llm_result('explanation', (cache_key, llm_model_for_exp),
+                                 lambda: explainers[llm_model_for_exp](saliency_image, result, prediction[0][class_index]))
         st.write(explanation)
     else:
+      cancel_llm_task('explanation')
       st.warning("Please select your model to generate explanation.")
       explanation = ""
 
+    if explanation != "" and llm_model_for_exp not in explanations:
+      cached = result_cache.update(cache_key, explanations={**explanations, llm_model_for_exp: explanation})
+
     if explanation != "":
         # Generate and allow download of the report
         if "downloaded" not in st.session_state:
@@ -482,26 +336,30 @@ with col[2]:
             st.session_state.show_message = False
 
         st.write("## Download Report")
-        with st.spinner('Generating report...'):
-
-            # Create a downloadable pdf that is a report on the findings
-            report_path = create_pdf_report(
-                    prediction=prediction[0],
-                    confidence=prediction[0][class_index],
-                    result=result,
-                    saliency_map_path=saliency_map_path
-                )
-        with open(report_path, "rb") as f:
-              if st.download_button(
-                label="Download Report as PDF",
-                data=f,
-                file_name="Brain_Tumor_Classification_Report.pdf",
-                mime="application/pdf"
-              ):
-
-
-                st.session_state.downloaded = True
-                st.session_state.show_message = True
+        if llm_model_for_exp not in reports:
+          with st.spinner('Generating report...'):
+              from report import create_pdf_report
+
+              # Create a downloadable pdf that is a report on the findings
+              report = create_pdf_report(
+                      prediction=prediction[0],
+                      confidence=prediction[0][class_index],
+                      result=result,
+                      saliency_map=saliency_map,
+                      explanation=explanation,
+                      cases=pipeline.similar_cases(image_bytes, model)
+                  )
+          reports = {**reports, llm_model_for_exp: report}
+          cached = result_cache.update(cache_key, reports=reports)
+
+        if st.download_button(
+          label="Download Report as PDF",
+          data=reports[llm_model_for_exp],
+          file_name="Brain_Tumor_Classification_Report.pdf",
+          mime="application/pdf"
+        ):
+          st.session_state.downloaded = True
+          st.session_state.show_message = True
 
         if st.session_state.downloaded:
           st.success("The report has been successfully downloaded!")
@@ -540,41 +398,88 @@ with col[2]:
               </style>
           """, unsafe_allow_html=True)
 
+          from chat import ChatSession
+
+          # One chat session per scan: the saliency image is uploaded once
+          # and the prompt history stays bounded however long the chat runs.
+          chat = st.session_state.get('chat')
+          if chat is None or chat.key != cache_key:
+            close_chat()
+            chat = st.session_state.chat = ChatSession(cache_key, result, prediction[0][class_index], saliency_image)
+
           # Wrap chat messages in a container for custom styling
           chat_container = st.empty()
           with chat_container.container():
-              # initialize the chat history
-              if "messages" not in st.session_state:
-                  intro_message = "Is there anything more you would like me to explain about the MRI Scan?"
-                  st.session_state.messages = [{"role": "assistant", "content": intro_message}]
-
               # Display chat messages from history on app rerun
-              for message in st.session_state.messages:
+              for message in chat.messages:
                   with st.chat_message(message["role"]):
                       st.markdown(message["content"])
 
           # Pin chat_input to the bottom
           user_question = st.chat_input("Ask a follow question about the MRI scan")
           if user_question:
-              # Display user message in chat message container
-              st.session_state.messages.append({"role": "user", "content": user_question})
-              # chat_container.empty()  # Clear container to refresh chat
-
               with chat_container.container(height=400):
-                  for message in st.session_state.messages:
+                  for message in list(chat.messages) + [{"role": "user", "content": user_question}]:
                       with st.chat_message(message["role"]):
                           st.markdown(message["content"])
-                  # Add new messages dynamically
-                  # st.chat_message("user").markdown(user_question)
 
-                  # Display assistant response in chat message container
+                  # Tokens are rendered into a single element as they arrive.
                   with st.chat_message("assistant"):
-                      with st.spinner('Generating response...'):
-                          full_response = ''
-                          for response in generate_chat_response_gemini(user_question, user_type, result, prediction[0][class_index], saliency_map_path):
-                              full_response += response
-                              st.markdown(response)
-                          # st.markdown(full_response)
-
-                  # Add assistant response to chat history
-                  st.session_state.messages.append({"role": "assistant", "content": full_response})
+                      placeholder = st.empty()
+                      full_response = ''
+                      for response in llm_client.iterate(chat.ask(user_question, user_type)):
+                          full_response += response
+                          placeholder.markdown(full_response + "▌")
+                      placeholder.markdown(full_response)
+
+
+with col[1]:
+  if study_files and uploaded_file is None:
+    import hashlib
+
+    from model_registry import CUSTOM_CNN, XCEPTION
+    from saliency import METHODS
+    from studies import classify_study, iter_study_slices, suspicion
+
+    study_model = st.radio("Select a model:", (XCEPTION, CUSTOM_CNN), key='study_model')
+    study_method = st.radio("Saliency method:", list(METHODS), format_func=METHODS.get, horizontal=True,
+                            key='study_method')
+    registry = get_model_registry()
+    result_cache = get_result_cache()
+    # Keyed by the hash of every file, so reruns never read the study again.
+    study_digest = b''.join(hashlib.sha256(f.getvalue()).digest() for f in study_files)
+    study_key = make_cache_key(study_digest,
+                               f"study:{registry.model_id(study_model, inference_backend)}#{study_method}")
+    cached = result_cache.get(study_key)
+    if cached is None:
+      try:
+        with st.spinner("Classifying the study's slices..."):
+          study = classify_study(iter_study_slices(study_files), study_model, saliency_method=study_method,
+                                 backend=inference_backend, registry=registry, audit=get_audit_store(),
+                                 source='app')
+      except Exception as exc:
+        st.error(f"Could not read the study: {exc}")
+        st.stop()
+      cached = result_cache.update(study_key, study=study)
+    study = cached['study']
+
+    st.write(f"## Study verdict: {study.label} ({study.confidence * 100:.2f}%)")
+    st.caption(f"Decided by the {len(study.top_slices)} most suspicious of {len(study.slice_ids)} slices.")
+    st.line_chart({'Tumor probability per slice': suspicion(study.probabilities)})
+    for column, index in zip(st.columns(len(study.top_slices)), study.top_slices):
+      with column:
+        st.image(study.saliency_maps[index], use_container_width=True,
+                 caption=f"{study.slice_ids[index]}: tumor {suspicion(study.probabilities[index]) * 100:.1f}%")
+
+
+if uploaded_file is not None:
+  trace = METRICS.finish_trace(trace_token)
+  # Append ?trace=1 to the URL to see where this run's time went.
+  if st.query_params.get("trace"):
+    with st.sidebar.expander("Request trace", expanded=True):
+      st.write(f"Trace `{trace.id}`: {trace.duration * 1000:.0f} ms")
+      st.dataframe([
+        {'stage': span['name'], **{k: v for k, v in span.items() if k not in ('name', 'offset', 'duration')},
+         'start (ms)': round(span['offset'] * 1000, 1), 'duration (ms)': round(span['duration'] * 1000, 1)}
+        for span in trace.spans
+      ])
@@ -0,0 +1,285 @@
+"""Append-only audit log of every classification, in a local SQLite file.
+
+    python audit_store.py --since 2026-10-01 --model 'Custom CNN'
+    python audit_store.py --image 3f2a... --bucket-hours 1
+
+One row per classification: when, which image (SHA-256 of the uploaded
+bytes), which model and weights, the four class probabilities, the stage
+latencies and references to the artifacts it produced (result cache key,
+saliency overlay or report files). `record` only queues the row; a writer
+thread inserts queued rows in batches, so requests never wait on the disk.
+Rows cannot be updated or deleted. Time, predicted class, image hash and
+model are indexed, so range and per-class queries stay fast as the log
+grows to millions of rows.
+"""
+import argparse
+import atexit
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import urllib.parse
+from contextlib import closing
+from datetime import datetime
+
+from metrics import METRICS
+
+# The class order of model_registry.LABELS, repeated here so reading the log
+# does not import TensorFlow.
+LABELS = ['Glioma', 'Meningioma', 'No tumor', 'Pituitary']
+PROB_COLUMNS = ['prob_' + label.lower().replace(' ', '_') for label in LABELS]
+
+DEFAULT_PATH = os.getenv("AUDIT_DB", "audit.db")
+DEFAULT_BATCH_SIZE = 256
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_MAX_PENDING = 10000
+
+COLUMNS = ['ts', 'source', 'image_hash', 'model', 'model_version', 'backend', 'saliency_method', 'predicted',
+           'confidence'] + PROB_COLUMNS + ['latencies', 'artifacts']
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS predictions (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    source TEXT,
+    image_hash TEXT NOT NULL,
+    model TEXT NOT NULL,
+    model_version TEXT,
+    backend TEXT,
+    saliency_method TEXT,
+    predicted TEXT NOT NULL,
+    confidence REAL NOT NULL,
+    {', '.join(f'{column} REAL NOT NULL' for column in PROB_COLUMNS)},
+    latencies TEXT,
+    artifacts TEXT
+);
+CREATE INDEX IF NOT EXISTS predictions_ts ON predictions (ts);
+CREATE INDEX IF NOT EXISTS predictions_predicted_ts ON predictions (predicted, ts);
+CREATE INDEX IF NOT EXISTS predictions_image_hash ON predictions (image_hash);
+CREATE INDEX IF NOT EXISTS predictions_model_ts ON predictions (model, ts);
+CREATE TRIGGER IF NOT EXISTS predictions_no_update BEFORE UPDATE ON predictions
+BEGIN SELECT RAISE(ABORT, 'the audit log is append-only'); END;
+CREATE TRIGGER IF NOT EXISTS predictions_no_delete BEFORE DELETE ON predictions
+BEGIN SELECT RAISE(ABORT, 'the audit log is append-only'); END;
+"""
+
+INSERT = f"INSERT INTO predictions ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+
+# Queued by close() to stop the writer once everything before it is written.
+_STOP = object()
+
+
+def _where(since=None, until=None, label=None, image_hash=None, model=None):
+    clauses, params = [], []
+    for clause, value in (('ts >= ?', since), ('ts < ?', until), ('predicted = ?', label),
+                          ('image_hash = ?', image_hash), ('model = ?', model)):
+        if value is not None:
+            clauses.append(clause)
+            params.append(value)
+    return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+
+class AuditLog:
+    """Read-only queries over the audit log in the SQLite file at `path`.
+
+    Every query opens its own read-only connection, so reading never
+    creates the file or writes to it.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+
+    def _read(self):
+        return sqlite3.connect(f"file:{urllib.parse.quote(os.path.abspath(self.path))}?mode=ro", uri=True,
+                               check_same_thread=False)
+
+    def query(self, since=None, until=None, label=None, image_hash=None, model=None, limit=None):
+        """Rows as dicts, oldest first, filtered on the indexed columns.
+
+        `since` and `until` are Unix timestamps. Rows are read lazily, so large
+        ranges can be iterated without loading them all.
+        """
+        where, params = _where(since, until, label, image_hash, model)
+        sql = f"SELECT id, {', '.join(COLUMNS)} FROM predictions{where} ORDER BY ts"
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with closing(self._read()) as conn:
+            for values in conn.execute(sql, params):
+                row = dict(zip(['id'] + COLUMNS, values))
+                row['probabilities'] = {label: row.pop(column) for label, column in zip(LABELS, PROB_COLUMNS)}
+                row['latencies'] = json.loads(row['latencies'] or '{}')
+                row['artifacts'] = json.loads(row['artifacts'] or '{}')
+                yield row
+
+    def class_counts(self, since=None, until=None, model=None):
+        # {label: rows predicted as it}, every label present.
+        where, params = _where(since, until, model=model)
+        with closing(self._read()) as conn:
+            counts = dict(conn.execute(f"SELECT predicted, COUNT(*) FROM predictions{where} GROUP BY predicted",
+                                       params).fetchall())
+        return {label: counts.get(label, 0) for label in LABELS}
+
+    def drift(self, bucket_seconds=86400, since=None, until=None, model=None):
+        """Per time bucket: row count, mean probability and predicted share per class.
+
+        A class whose mean probability or share moves between buckets is
+        what drift in the inputs (or a changed model) looks like.
+        """
+        where, params = _where(since, until, model=model)
+        means = ', '.join(f'AVG({column})' for column in PROB_COLUMNS)
+        shares = ', '.join('AVG(predicted = ?)' for _ in LABELS)
+        sql = (f"SELECT CAST(ts / ? AS INTEGER) AS bucket, COUNT(*), {means}, {shares} "
+               f"FROM predictions{where} GROUP BY bucket ORDER BY bucket")
+        with closing(self._read()) as conn:
+            rows = conn.execute(sql, [bucket_seconds] + LABELS + params).fetchall()
+        n = len(LABELS)
+        return [{'start': bucket * bucket_seconds, 'count': count,
+                 'mean_probabilities': dict(zip(LABELS, values[:n])),
+                 'predicted_share': dict(zip(LABELS, values[n:]))}
+                for bucket, count, *values in rows]
+
+
+class AuditStore(AuditLog):
+    """The audit log at `path`, appended to by a background writer.
+
+    Up to `batch_size` queued rows, or whatever arrived within
+    `flush_interval` seconds of the first, go in one transaction. Once
+    `max_pending` rows are waiting, new ones are dropped and counted in
+    `audit_dropped_total` rather than blocking the caller, unless it asks
+    to `wait`.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 max_pending=DEFAULT_MAX_PENDING):
+        super().__init__(path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn:
+            # WAL lets dashboards read while the app, the API and batch jobs append.
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+        self._queue = queue.Queue(max_pending)
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, name='audit-writer', daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def record(self, image_hash, model, probabilities, model_version=None, latencies=None, artifacts=None,
+               source=None, backend=None, saliency_method=None, timestamp=None, wait=False):
+        """Queue one classification; returns False if it had to be dropped.
+
+        `latencies` maps stage names to seconds and `artifacts` names what the
+        classification left behind (e.g. `{'cache_key': ...}` or file paths).
+        With `wait`, a full queue blocks instead, as batch jobs prefer.
+        """
+        probabilities = [float(p) for p in probabilities]
+        class_index = max(range(len(LABELS)), key=probabilities.__getitem__)
+        row = (time.time() if timestamp is None else timestamp, source, image_hash, model, model_version, backend,
+               saliency_method, LABELS[class_index], probabilities[class_index], *probabilities,
+               json.dumps(latencies or {}), json.dumps(artifacts or {}))
+        try:
+            self._queue.put(row, block=wait)
+        except queue.Full:
+            METRICS.inc('audit_dropped_total')
+            return False
+        return True
+
+    def flush(self):
+        # Wait until every row queued so far is committed.
+        self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._writer.join()
+
+    def _write_loop(self):
+        with closing(self._connect()) as conn:
+            stopping = False
+            while not stopping:
+                rows = [self._queue.get()]
+                deadline = time.monotonic() + self.flush_interval
+                while len(rows) < self.batch_size and rows[-1] is not _STOP:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        rows.append(self._queue.get(timeout=timeout))
+                    except queue.Empty:
+                        break
+                stopping = rows[-1] is _STOP
+                records = [row for row in rows if row is not _STOP]
+                try:
+                    if records:
+                        with METRICS.timer('audit_write_seconds'), conn:
+                            conn.executemany(INSERT, records)
+                        METRICS.inc('audit_records_total', len(records))
+                except sqlite3.Error:
+                    METRICS.inc('audit_write_errors_total', len(records))
+                finally:
+                    for _ in rows:
+                        self._queue.task_done()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_audit_store():
+    """The process-wide store at AUDIT_DB, or None when AUDIT_DB is set empty."""
+    global _store
+    if not DEFAULT_PATH:
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = AuditStore(DEFAULT_PATH)
+        return _store
+
+
+def _timestamp(value):
+    return datetime.fromisoformat(value).timestamp() if value else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize the classification audit log.")
+    parser.add_argument('--db', default=DEFAULT_PATH)
+    parser.add_argument('--since', default=None, help="ISO date or time, e.g. 2026-10-01.")
+    parser.add_argument('--until', default=None)
+    parser.add_argument('--model', default=None, help="Model name as recorded, e.g. 'Custom CNN'.")
+    parser.add_argument('--image', default=None, help="List every classification of this image hash.")
+    parser.add_argument('--bucket-hours', type=float, default=24)
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        parser.error(f"No audit log at {args.db}")
+    store = AuditLog(args.db)
+    since, until = _timestamp(args.since), _timestamp(args.until)
+    if args.image:
+        for row in store.query(since, until, image_hash=args.image, model=args.model):
+            print(f"{datetime.fromtimestamp(row['ts']).isoformat(timespec='seconds')}  {row['model_version']}  "
+                  f"{row['predicted']} ({row['confidence'] * 100:.2f}%)  {json.dumps(row['artifacts'])}")
+        return
+
+    counts = store.class_counts(since, until, args.model)
+    print(f"{sum(counts.values())} classifications: "
+          + ', '.join(f"{label} {count}" for label, count in counts.items()))
+    print(f"{'bucket start':<22}{'count':>8}" + ''.join(f"{label:>12}" for label in LABELS) + "  (mean prob.)")
+    for bucket in store.drift(args.bucket_hours * 3600, since, until, args.model):
+        print(f"{datetime.fromtimestamp(bucket['start']).isoformat(timespec='minutes'):<22}{bucket['count']:>8}"
+              + ''.join(f"{bucket['mean_probabilities'][label]:>12.3f}" for label in LABELS))
+
+
+if __name__ == '__main__':
+    main()
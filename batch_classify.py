@@ -0,0 +1,320 @@
+"""Classify a directory tree of MRI scans without the Streamlit UI.
+
+    python batch_classify.py /data/archive --output results.csv
+    python batch_classify.py /data/archive --model cnn --format parquet --output results/
+
+Images are decoded in parallel through a tf.data pipeline, classified in
+batches and appended to the output as each batch finishes. Re-running the same
+command after a crash skips every image already present in the output.
+
+With --report-dir, a PDF report is also written per scan, explained by the
+chosen LLM and rendered in a process pool alongside classification.
+"""
+import argparse
+import asyncio
+import csv
+import glob
+import io
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import PIL.Image
+import tensorflow as tf
+
+import llm_client
+from audit_store import get_audit_store
+from dataset import iter_class_paths
+from inference_engine import make_forward
+from llm_providers import configure
+from model_registry import LABELS, MODELS, get_registry
+from preprocessing import decode_image
+from report import render_reports, report_pool
+from result_cache import image_digest
+from saliency import INPUT_GRADIENTS, METHODS, classify_and_explain, generate_saliency_maps
+from similar_cases import find_similar_cases
+
+EXPLAINERS = {
+    'gemini': llm_client.generate_explanation_gemini,
+    'pixtral': llm_client.generate_explanation_pixtral,
+}
+
+COLUMNS = ['path', 'label', 'predicted', 'confidence'] + [f'prob_{label}' for label in LABELS] + ['error']
+
+
+class CsvSink:
+    def __init__(self, path):
+        self.path = path
+        self._truncate_partial_line()
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'a', newline='')
+        self._writer = csv.writer(self._file)
+        if is_new:
+            self._writer.writerow(COLUMNS)
+            self._file.flush()
+
+    def _truncate_partial_line(self):
+        # A crash mid-write can leave half a row at the end of the file.
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+
+    def done_paths(self):
+        if not os.path.exists(self.path):
+            return set()
+        with open(self.path, newline='') as f:
+            return {row['path'] for row in csv.DictReader(f)}
+
+    def write(self, rows):
+        self._writer.writerows([[row[column] for column in COLUMNS] for row in rows])
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetSink:
+    # Parquet files are only readable once their footer is written, so each
+    # batch becomes its own part file, published with an atomic rename.
+    def __init__(self, path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as exc:
+            raise ImportError("Parquet output needs pyarrow (pip install pyarrow), or use a .csv --output") from exc
+
+        self._pa, self._pq = pa, pq
+        # Explicit types, so a part holding only failed rows (all nulls) has
+        # the same schema as the others and the parts read back as one dataset.
+        self._schema = pa.schema([(column, pa.float64() if column == 'confidence' or column.startswith('prob_')
+                                   else pa.string()) for column in COLUMNS])
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._parts = len(glob.glob(os.path.join(path, 'part-*.parquet')))
+
+    def done_paths(self):
+        done = set()
+        for part in glob.glob(os.path.join(self.path, 'part-*.parquet')):
+            done.update(self._pq.read_table(part, columns=['path']).column('path').to_pylist())
+        return done
+
+    def write(self, rows):
+        table = self._pa.Table.from_pylist(rows, schema=self._schema)
+        part = os.path.join(self.path, f'part-{self._parts:06d}.parquet')
+        self._pq.write_table(table, part + '.tmp')
+        os.replace(part + '.tmp', part)
+        self._parts += 1
+
+    def close(self):
+        pass
+
+
+def build_dataset(items, img_size, batch_size, parallelism):
+    def generate():
+        yield from items
+
+    def decode(path, label):
+        def load(path):
+            # The file is read once for both the decode and the audit log's hash.
+            try:
+                with open(path.decode(), 'rb') as f:
+                    data = f.read()
+                return decode_image(io.BytesIO(data), img_size), image_digest(data).encode(), True
+            except Exception:
+                return np.zeros(img_size + (3,), dtype=np.uint8), b'', False
+
+        # Batches stay uint8 until the model normalizes them on-graph.
+        img_array, digest, ok = tf.numpy_function(load, [path], (tf.uint8, tf.string, tf.bool))
+        img_array.set_shape(img_size + (3,))
+        digest.set_shape(())
+        ok.set_shape(())
+        return path, label, img_array, digest, ok
+
+    ds = tf.data.Dataset.from_generator(
+        generate,
+        output_signature=(tf.TensorSpec((), tf.string), tf.TensorSpec((), tf.string)))
+    ds = ds.map(decode, num_parallel_calls=parallelism, deterministic=True)
+    return ds.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+def to_rows(paths, labels, probabilities, ok):
+    rows = []
+    for path, label, probs, decoded in zip(paths, labels, probabilities, ok):
+        row = {'path': path.decode(), 'label': label.decode()}
+        if decoded:
+            class_index = int(np.argmax(probs))
+            row.update(predicted=LABELS[class_index], confidence=float(probs[class_index]), error='')
+            row.update({f'prob_{name}': float(p) for name, p in zip(LABELS, probs)})
+        else:
+            row.update(predicted='', confidence=None, error='decode failed')
+            row.update({f'prob_{name}': None for name in LABELS})
+        rows.append(row)
+    return rows
+
+
+def record_batch(audit, paths, digests, probabilities, ok, model_name, model_version, backend, forward_seconds,
+                 root, saliency_dir, saliency_method, report_dir):
+    # One audit row per decoded scan, pointing at the files written for it.
+    for path, digest, probs, decoded in zip(paths, digests, probabilities, ok):
+        if not decoded:
+            continue
+        artifacts = {'path': path.decode()}
+        if saliency_dir:
+            artifacts['saliency_map'] = os.path.join(saliency_dir, output_name(root, path) + '.png')
+        if report_dir:
+            artifacts['report'] = os.path.join(report_dir, output_name(root, path) + '.pdf')
+        # The batch's forward pass, shared evenly among its scans.
+        audit.record(digest.decode(), model_name, probs, model_version=model_version,
+                     latencies={'forward': forward_seconds / len(probabilities)}, artifacts=artifacts,
+                     source='batch', backend=backend, saliency_method=saliency_method if saliency_dir else None,
+                     wait=True)
+
+
+def output_name(root, path):
+    # <root>/glioma/scan.jpg -> glioma__scan
+    return os.path.splitext(os.path.relpath(path.decode(), root).replace(os.sep, '__'))[0]
+
+
+def write_saliency_maps(saliency_dir, root, paths, saliency_maps):
+    for path, saliency_map in zip(paths, saliency_maps):
+        cv2.imwrite(os.path.join(saliency_dir, output_name(root, path) + '.png'),
+                    cv2.cvtColor(saliency_map, cv2.COLOR_RGB2BGR))
+
+
+def write_reports(report_dir, root, paths, probabilities, saliency_maps, img_arrays, explainer, pool):
+    results = [(LABELS[int(np.argmax(probs))], float(np.max(probs))) for probs in probabilities]
+    # Every explanation for the batch is requested at once; the similar cases
+    # are one batched lookup while they are generated.
+    async def explain_all():
+        return await asyncio.gather(*[explainer(PIL.Image.fromarray(saliency_map), result, confidence)
+                                      for saliency_map, (result, confidence) in zip(saliency_maps, results)])
+
+    explanations = llm_client.submit(explain_all())
+    cases = [[case.describe() for case in similar]
+             for similar in find_similar_cases(img_arrays, sources=[path.decode() for path in paths])]
+    jobs = [dict(prediction=probs, confidence=confidence, result=result, saliency_map=saliency_map,
+                 explanation=explanation, cases=similar)
+            for probs, (result, confidence), saliency_map, explanation, similar
+            in zip(probabilities, results, saliency_maps, explanations.result(), cases)]
+    for path, report in zip(paths, render_reports(jobs, executor=pool)):
+        with open(os.path.join(report_dir, output_name(root, path) + '.pdf'), 'wb') as f:
+            f.write(report)
+
+
+def classify_directory(root, sink, model_name, batch_size=32, parallelism=tf.data.AUTOTUNE, weights=None,
+                       saliency_dir=None, backend='keras', report_dir=None, report_llm='gemini',
+                       saliency_method=INPUT_GRADIENTS, audit=None, log=sys.stderr):
+    registry = get_registry()
+    if weights:
+        registry.swap(model_name, weights)
+    model_version = registry.model_id(model_name, backend)
+    img_size = registry.spec(model_name).img_size
+    if backend == 'tflite':
+        tflite_model = registry.get_tflite(model_name)
+        forward = lambda img_arrays: tflite_model.predict(img_arrays.numpy())
+    else:
+        keras_forward = make_forward(registry.get(model_name), img_size)
+        forward = lambda img_arrays: keras_forward(img_arrays).numpy()
+    explain = backend != 'tflite' and bool(saliency_dir or report_dir)
+    if saliency_dir:
+        os.makedirs(saliency_dir, exist_ok=True)
+    pool = None
+    if report_dir:
+        os.makedirs(report_dir, exist_ok=True)
+        pool = report_pool()
+
+    done = sink.done_paths()
+    items = ((path, label) for path, label in iter_class_paths(root) if path not in done)
+    if done:
+        print(f"Resuming: {len(done)} images already classified", file=log)
+
+    total = 0
+    start = time.perf_counter()
+    try:
+        for paths, labels, img_arrays, digests, ok in build_dataset(items, img_size, batch_size, parallelism):
+            decoded = ok.numpy()
+            saliency_maps = None
+            forward_start = time.perf_counter()
+            if explain and decoded.any():
+                # One taped pass yields both the probabilities and the maps of
+                # the decoded scans; rows that failed to decode stay zero.
+                explained = classify_and_explain(registry.get(model_name), img_arrays.numpy()[decoded], lazy=True,
+                                                 method=saliency_method)
+                probabilities = np.zeros((len(decoded), len(LABELS)), dtype=np.float32)
+                probabilities[decoded] = explained.probabilities
+                forward_seconds = time.perf_counter() - forward_start
+                saliency_maps = explained.saliency_maps()
+            else:
+                probabilities = forward(img_arrays)
+                forward_seconds = time.perf_counter() - forward_start
+                if (saliency_dir or report_dir) and decoded.any():
+                    # The TFLite model has no gradients; the maps come from Keras.
+                    saliency_maps = generate_saliency_maps(registry.get(model_name), img_arrays.numpy()[decoded],
+                                                           probabilities[decoded].argmax(axis=1),
+                                                           method=saliency_method)
+            if saliency_maps is not None:
+                if saliency_dir:
+                    write_saliency_maps(saliency_dir, root, paths.numpy()[decoded], saliency_maps)
+                if report_dir:
+                    write_reports(report_dir, root, paths.numpy()[decoded], probabilities[decoded], saliency_maps,
+                                  img_arrays.numpy()[decoded], EXPLAINERS[report_llm], pool)
+            sink.write(to_rows(paths.numpy(), labels.numpy(), probabilities, ok.numpy()))
+            if audit is not None:
+                record_batch(audit, paths.numpy(), digests.numpy(), probabilities, ok.numpy(), model_name,
+                             model_version, backend, forward_seconds, root, saliency_dir, saliency_method, report_dir)
+            total += len(probabilities)
+            elapsed = time.perf_counter() - start
+            print(f"\r{total} images, {total / elapsed:.1f} img/s", end='', file=log, flush=True)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if audit is not None:
+            audit.flush()
+    print(file=log)
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Classify a directory tree of brain MRI scans.")
+    parser.add_argument('root', help="Directory to scan, laid out as <root>/<label>/<image> or flat.")
+    parser.add_argument('--output', required=True, help="CSV file, or directory of Parquet parts.")
+    parser.add_argument('--format', choices=('csv', 'parquet'), default=None,
+                        help="Output format (default: inferred from --output).")
+    parser.add_argument('--model', choices=sorted(MODELS), default='xception')
+    parser.add_argument('--weights', default=None, help="Override the model's weight file.")
+    parser.add_argument('--backend', choices=('keras', 'tflite'), default=os.getenv('INFERENCE_BACKEND', 'keras'),
+                        help="Run inference with Keras or the exported TFLite model (see tflite_backend.py).")
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--saliency-dir', default=None,
+                        help="Also write a saliency overlay PNG per image into this directory.")
+    parser.add_argument('--saliency-method', choices=sorted(METHODS), default=INPUT_GRADIENTS,
+                        help="How saliency maps are computed: input gradients, or Grad-CAM(++) at the last conv layer.")
+    parser.add_argument('--report-dir', default=None,
+                        help="Also write a PDF report per image into this directory (calls the LLM per image).")
+    parser.add_argument('--report-llm', choices=sorted(EXPLAINERS), default='gemini',
+                        help="LLM that writes the reports' explanations.")
+    parser.add_argument('--parallelism', type=int, default=tf.data.AUTOTUNE,
+                        help="Parallel decode calls (default: autotune).")
+    args = parser.parse_args(argv)
+
+    if args.report_dir:
+        configure(google_api_key=os.getenv("GOOGLE_API_KEY"), pixtral_api_key=os.getenv("PIXTRAL_API_KEY"))
+
+    output_format = args.format or ('csv' if args.output.endswith('.csv') else 'parquet')
+    sink = CsvSink(args.output) if output_format == 'csv' else ParquetSink(args.output)
+    try:
+        classify_directory(args.root, sink, MODELS[args.model], args.batch_size, args.parallelism, args.weights,
+                           args.saliency_dir, args.backend, args.report_dir, args.report_llm, args.saliency_method,
+                           get_audit_store())
+    finally:
+        sink.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""Offline latency benchmark for the upload pipeline.
+
+    python benchmark.py --synthetic 20 --untrained
+    python benchmark.py --images /data/Testing --model cnn --llm-latency 1.5 --llm-tokens-per-second 40
+
+Runs decode -> predict -> saliency -> explanation -> similar cases -> PDF for
+each image the way the app does, with every LLM call served by the local
+stand-in provider, and reports per-stage and end-to-end latency. No network
+access is needed.
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import numpy as np
+import PIL.Image
+
+import llm_client
+from dataset import iter_class_paths
+from llm_providers import LocalProvider, set_provider
+from model_registry import LABELS, MODELS, get_registry
+from preprocessing import decode_image
+from report import create_pdf_report
+from saliency import classify_and_explain
+from similar_cases import find_similar_cases
+
+STAGES = ['decode', 'predict', 'saliency', 'explanation', 'similar_cases', 'pdf', 'total']
+
+
+def synthetic_images(directory, count, size=(512, 512)):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f'synthetic_{i:04d}.png')
+        PIL.Image.fromarray(rng.integers(0, 256, size + (3,), dtype=np.uint8)).save(path)
+        paths.append(path)
+    return paths
+
+
+def run_upload(path, model, img_size):
+    timings = {}
+    start = stage_start = time.perf_counter()
+
+    def lap(stage):
+        nonlocal stage_start
+        now = time.perf_counter()
+        timings[stage] = now - stage_start
+        stage_start = now
+
+    img_array = decode_image(path, img_size)[np.newaxis]
+    lap('decode')
+
+    explained = classify_and_explain(model, img_array, lazy=True)
+    prediction = explained.probabilities
+    class_index = int(np.argmax(prediction[0]))
+    result, confidence = LABELS[class_index], prediction[0][class_index]
+    lap('predict')
+
+    saliency_map = explained.saliency_maps()[0]
+    lap('saliency')
+
+    explanation = llm_client.run(
+        llm_client.generate_explanation_gemini(PIL.Image.fromarray(saliency_map), result, confidence))
+    lap('explanation')
+
+    cases = [case.describe() for case in find_similar_cases(img_array, sources=[path])[0]]
+    lap('similar_cases')
+
+    create_pdf_report(prediction[0], confidence, result, saliency_map, explanation, cases)
+    lap('pdf')
+
+    timings['total'] = time.perf_counter() - start
+    return timings
+
+
+def summarize(samples):
+    summary = {}
+    for stage in STAGES:
+        values = np.array(samples[stage]) * 1000.0
+        summary[stage] = {
+            'mean_ms': float(values.mean()),
+            'p50_ms': float(np.percentile(values, 50)),
+            'p95_ms': float(np.percentile(values, 95)),
+            'max_ms': float(values.max()),
+        }
+    return summary
+
+
+def print_summary(summary, count, out=sys.stdout):
+    print(f"{count} uploads", file=out)
+    print(f"{'stage':<14}{'mean':>10}{'p50':>10}{'p95':>10}{'max':>10}  (ms)", file=out)
+    for stage, row in summary.items():
+        print(f"{stage:<14}{row['mean_ms']:>10.1f}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['max_ms']:>10.1f}", file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the upload pipeline without network access.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--images', help="Directory of scans, laid out as <root>/<label>/<image> or flat.")
+    source.add_argument('--synthetic', type=int, help="Benchmark this many generated noise images.")
+    parser.add_argument('--limit', type=int, default=None, help="Use at most this many images from --images.")
+    parser.add_argument('--model', choices=sorted(MODELS), default='xception')
+    parser.add_argument('--untrained', action='store_true',
+                        help="Use randomly initialised weights (same latency, no weight file needed).")
+    parser.add_argument('--warmup', type=int, default=2, help="Uploads to run before measuring.")
+    parser.add_argument('--llm-latency', type=float, default=0.0, help="Stand-in LLM time to first token, seconds.")
+    parser.add_argument('--llm-tokens-per-second', type=float, default=0.0,
+                        help="Stand-in LLM streaming rate (0 = unpaced).")
+    parser.add_argument('--json', default=None, help="Also write the summary to this file.")
+    args = parser.parse_args(argv)
+
+    provider = LocalProvider(latency=args.llm_latency, tokens_per_second=args.llm_tokens_per_second)
+    set_provider('gemini', provider)
+    set_provider('pixtral', provider)
+
+    registry = get_registry()
+    name = MODELS[args.model]
+    spec = registry.spec(name)
+    model = spec.builder() if args.untrained else registry.get(name)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.synthetic:
+            paths = synthetic_images(work_dir, args.synthetic)
+        else:
+            paths = [path for path, _ in itertools.islice(iter_class_paths(args.images), args.limit)]
+        if not paths:
+            parser.error("no images to benchmark")
+
+        for path in itertools.islice(itertools.cycle(paths), args.warmup):
+            run_upload(path, model, spec.img_size)
+
+        samples = defaultdict(list)
+        for path in paths:
+            for stage, seconds in run_upload(path, model, spec.img_size).items():
+                samples[stage].append(seconds)
+
+    summary = summarize(samples)
+    print_summary(summary, len(paths))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'model': name, 'uploads': len(paths), 'stages': summary}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
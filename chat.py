@@ -0,0 +1,104 @@
+import asyncio
+from collections import deque
+
+from llm_client import DEFAULT_TIMEOUT, call_with_retry, chat_prompt, stream_with_retry
+from llm_providers import get_provider
+
+MAX_RECENT_TURNS = 4
+MAX_SUMMARY_CHARS = 1500
+MAX_DISPLAY_MESSAGES = 50
+
+INTRO_MESSAGE = "Is there anything more you would like me to explain about the MRI Scan?"
+
+
+def summary_prompt(summary, turns, model_prediction):
+    conversation = "\n".join(f"User: {question}\nAssistant: {answer}" for question, answer in turns)
+    prompt = f"""Summarize this conversation about an MRI scan that a deep learning model classified as '{model_prediction}'.
+  Keep the facts the assistant explained and what the user wanted to know, in at most 120 words.
+
+  Summary so far: {summary or "(none)"}
+
+  {conversation}
+  """
+    return prompt
+
+
+def history_prompt(summary, turns):
+    parts = ["Conversation so far:"]
+    if summary:
+        parts.append(f"(Summary of earlier messages) {summary}")
+    parts.extend(f"User: {question}\nAssistant: {answer}" for question, answer in turns)
+    return "\n".join(parts) + "\n"
+
+
+class ChatSession:
+    """The MRI chat for one scan.
+
+    The saliency image is uploaded to the provider once (`LLMProvider.upload`)
+    and every question refers to that upload. The prompt carries the last
+    `max_recent_turns` exchanges verbatim; older ones are folded into a
+    running summary in the background, so prompt size stays bounded however
+    long the conversation gets. `messages` is the transcript for display,
+    capped at `max_display_messages`. `close` deletes the upload once the
+    session is no longer needed.
+    """
+
+    def __init__(self, key, model_prediction, confidence, img, provider="gemini",
+                 max_recent_turns=MAX_RECENT_TURNS, max_display_messages=MAX_DISPLAY_MESSAGES):
+        self.key = key
+        self.model_prediction = model_prediction
+        self.confidence = confidence
+        self.provider = get_provider(provider)
+        self.max_recent_turns = max_recent_turns
+        self.messages = deque([{"role": "assistant", "content": INTRO_MESSAGE}], maxlen=max_display_messages)
+        self.summary = ""
+        self._img = img
+        self._image_ref = None
+        self._turns = []
+        self._compaction = None
+
+    async def _image(self):
+        if self._image_ref is None:
+            self._image_ref = await call_with_retry(self.provider.upload, self._img, call='chat_upload')
+            self._img = None
+        return self._image_ref
+
+    async def ask(self, question, user_type, timeout=DEFAULT_TIMEOUT):
+        """Stream the answer to `question`, recording the exchange once complete."""
+        self.messages.append({"role": "user", "content": question})
+        if self._compaction is not None:
+            await asyncio.wait([self._compaction])
+        contents = [chat_prompt(question, user_type, self.model_prediction, self.confidence), await self._image()]
+        if self._turns or self.summary:
+            contents.insert(0, history_prompt(self.summary, self._turns))
+
+        answer = ""
+        async for chunk in stream_with_retry(self.provider, contents, timeout=timeout):
+            answer += chunk
+            yield chunk
+
+        self.messages.append({"role": "assistant", "content": answer})
+        self._turns.append((question, answer))
+        if len(self._turns) > self.max_recent_turns:
+            self._compaction = asyncio.ensure_future(self._compact())
+
+    async def close(self):
+        ref, self._image_ref, self._img = self._image_ref, None, None
+        if self._compaction is not None:
+            self._compaction.cancel()
+        if ref is not None:
+            await call_with_retry(self.provider.delete, ref, call='chat_delete')
+
+    async def _compact(self):
+        older = self._turns[:-self.max_recent_turns]
+        self._turns = self._turns[-self.max_recent_turns:]
+        try:
+            summary = await call_with_retry(self.provider.generate,
+                                            [summary_prompt(self.summary, older, self.model_prediction)],
+                                            call='chat_summary')
+        except Exception:
+            # Without a summary the old turns are still dropped from the
+            # prompt; the bound matters more than the recap.
+            summary = " ".join([self.summary] + [f"User asked: {question}" for question, _ in older])
+        self.summary = summary.strip()[-MAX_SUMMARY_CHARS:]
+        self._compaction = None
@@ -0,0 +1,37 @@
+import os
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def iter_class_paths(path):
+    # Walks `path/<label>/<image>` like the notebook's get_class_paths, but
+    # yields lazily and in a stable order so long runs can be resumed.
+    for label in sorted(os.listdir(path)):
+        label_path = os.path.join(path, label)
+
+        if os.path.isdir(label_path):
+            for dirpath, dirnames, filenames in os.walk(label_path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(dirpath, filename), label
+        elif label.lower().endswith(IMAGE_EXTENSIONS):
+            yield label_path, ''
+
+
+def get_class_paths(path):
+    import pandas as pd
+
+    class_paths, classes = [], []
+    for image_path, label in iter_class_paths(path):
+        if not label:
+            continue
+        class_paths.append(image_path)
+        classes.append(label)
+
+    df = pd.DataFrame({
+        'Class Path': class_paths,
+        'Class': classes
+    })
+
+    return df
@@ -0,0 +1,88 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict
+
+import numpy as np
+
+from inference_engine import get_engine
+from metrics import METRICS
+from model_registry import CUSTOM_CNN, XCEPTION, get_registry
+from preprocessing import decode_images
+
+ENSEMBLE = "Ensemble - Xception + Custom CNN"
+
+# TFLite models have no engine thread of their own; this pool gives each
+# member a worker so they still run side by side.
+_tflite_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ensemble")
+
+
+@dataclass(frozen=True)
+class EnsemblePrediction:
+    probabilities: np.ndarray
+    per_model: Dict[str, np.ndarray]
+    agree: np.ndarray
+
+
+def combine(per_model, weights):
+    """Weighted average of each model's softmax output, plus top-1 agreement.
+
+    `per_model` maps model name to an `(n, classes)` probability array and
+    `weights` maps the same names to weights summing to one. `agree[i]` is
+    True when every model predicts the same class for image `i`.
+    """
+    names = list(per_model)
+    probabilities = sum(weights[name] * np.asarray(per_model[name]) for name in names)
+    top1 = np.stack([np.argmax(per_model[name], axis=1) for name in names])
+    return EnsemblePrediction(probabilities, dict(per_model), np.all(top1 == top1[0], axis=0))
+
+
+class Ensemble:
+    """Several registered models classifying the same scans together.
+
+    Each member gets the scan at its own input size from a single decode
+    (`decode`). `predict` hands every member's batch to that model's
+    inference engine at once, so the models run concurrently on their own
+    worker threads and the ensemble takes about as long as its slowest
+    member. Weights default to equal and are normalized to sum to one.
+    """
+
+    def __init__(self, names=(XCEPTION, CUSTOM_CNN), weights=None, backend='keras', registry=None):
+        self.registry = registry or get_registry()
+        self.names = tuple(names)
+        self.backend = backend
+        weights = weights or {}
+        raw = np.array([float(weights.get(name, 1.0)) for name in self.names])
+        if (raw < 0).any() or raw.sum() <= 0:
+            raise ValueError(f"Ensemble weights must be non-negative and not all zero, got {weights}")
+        self.weights = dict(zip(self.names, (raw / raw.sum()).tolist()))
+
+    @property
+    def img_sizes(self):
+        return {name: self.registry.spec(name).img_size for name in self.names}
+
+    def model_id(self):
+        # Changes whenever a member's weight file or the weighting does, so
+        # it can key cached results like a single model's id.
+        members = ','.join(f'{self.registry.model_id(name, self.backend)}*{self.weights[name]:.4f}'
+                           for name in self.names)
+        return f'ensemble[{members}]'
+
+    def decode(self, path_or_file):
+        # {model name: (H, W, 3) uint8 array} from one decode of the scan.
+        by_size = decode_images(path_or_file, set(self.img_sizes.values()))
+        return {name: by_size[img_size] for name, img_size in self.img_sizes.items()}
+
+    def _submit(self, name, img_batch):
+        if self.backend == 'tflite':
+            return _tflite_pool.submit(self.registry.get_tflite(name).predict, img_batch)
+        return get_engine(name, self.registry).submit(img_batch)
+
+    def predict(self, images):
+        """Classify `images`, a {model name: uint8 image or batch} dict."""
+        with METRICS.timer('predict_seconds', path='ensemble'):
+            futures = {}
+            for name in self.names:
+                img_batch = np.asarray(images[name])
+                futures[name] = self._submit(name, img_batch[np.newaxis] if img_batch.ndim == 3 else img_batch)
+            per_model = {name: future.result() for name, future in futures.items()}
+        return combine(per_model, self.weights)
@@ -0,0 +1,132 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import tensorflow as tf
+
+from metrics import METRICS
+from model_registry import get_registry
+from preprocessing import normalize
+
+DEFAULT_MAX_BATCH_SIZE = 16
+DEFAULT_MAX_WAIT_MS = 5
+
+_STOP = object()
+
+
+def make_forward(model, img_size):
+    # A single concrete graph for any batch size, without predict()'s per-call
+    # dataset and callback setup. Takes uint8 pixels and normalizes on-graph,
+    # so callers never materialize a float copy of the batch.
+    signature = [tf.TensorSpec(shape=(None,) + tuple(img_size) + (3,), dtype=tf.uint8)]
+    return tf.function(lambda x: model(normalize(x), training=False), input_signature=signature)
+
+
+class InferenceEngine:
+    """Groups concurrent `predict` calls into batches for a single model.
+
+    Callers submit `(n, H, W, 3)` uint8 arrays from any thread. A worker thread
+    collects up to `max_batch_size` images, waiting at most `max_wait_ms` for
+    the batch to fill, runs them through one graph call and routes each slice
+    of the output back to its caller's future.
+    """
+
+    def __init__(self, model, img_size, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS):
+        self.model = model
+        self.img_size = tuple(img_size)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self._forward = make_forward(model, self.img_size)
+
+        self._queue = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name=f"inference-{self.img_size[0]}", daemon=True)
+        self._worker.start()
+
+    def submit(self, img_array):
+        if self._closed:
+            raise RuntimeError("InferenceEngine is closed")
+        img_array = np.asarray(img_array)
+        if img_array.dtype != np.uint8:
+            raise ValueError(f"Expected uint8 pixels (see preprocessing.decode_image), got {img_array.dtype}")
+        if img_array.ndim == 3:
+            img_array = img_array[np.newaxis]
+        if img_array.shape[1:3] != self.img_size:
+            raise ValueError(f"Expected images of size {self.img_size}, got {img_array.shape[1:3]}")
+        future = Future()
+        self._queue.put((img_array, future))
+        return future
+
+    def predict(self, img_array, timeout=None):
+        return self.submit(img_array).result(timeout)
+
+    def close(self):
+        # Requests already queued are still served before the worker exits.
+        if not self._closed:
+            self._closed = True
+            self._queue.put(_STOP)
+
+    def _collect(self, first):
+        batch = [first]
+        size = len(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self._queue.put(_STOP)
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch = self._collect(item)
+            batch = [(array, future) for array, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                img_batch = batch[0][0] if len(batch) == 1 else np.concatenate([array for array, _ in batch])
+                with METRICS.timer('predict_seconds', path='engine'):
+                    outputs = self._forward(tf.constant(img_batch)).numpy()
+                METRICS.inc('inference_batches_total')
+                METRICS.inc('inference_images_total', len(img_batch))
+            except Exception as exc:
+                for _, future in batch:
+                    future.set_exception(exc)
+                continue
+            offset = 0
+            for array, future in batch:
+                future.set_result(outputs[offset:offset + len(array)])
+                offset += len(array)
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(name, registry=None, **kwargs):
+    # One engine per registered model; a new engine replaces the old one when
+    # the registry hands out a reloaded or swapped model.
+    registry = registry or get_registry()
+    model = registry.get(name)
+    with _engines_lock:
+        engine = _engines.get(name)
+        if engine is None or engine.model is not model:
+            if engine is not None:
+                engine.close()
+            engine = InferenceEngine(model, registry.spec(name).img_size, **kwargs)
+            _engines[name] = engine
+        return engine
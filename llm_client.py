@@ -0,0 +1,160 @@
+import asyncio
+import random
+import threading
+import time
+
+from llm_providers import get_provider
+from metrics import METRICS, bind_trace
+
+DEFAULT_TIMEOUT = 60.0
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.5
+
+async def call_with_retry(fn, *args, call='llm', timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, **kwargs):
+    # Each attempt gets its own timeout; failures back off exponentially with
+    # jitter. Cancellation is never retried.
+    with METRICS.timer('llm_seconds', call=call):
+        for attempt in range(retries + 1):
+            try:
+                return await asyncio.wait_for(fn(*args, **kwargs), timeout)
+            except asyncio.CancelledError:
+                METRICS.inc('llm_cancelled_total', call=call)
+                raise
+            except Exception:
+                METRICS.inc('llm_errors_total', call=call)
+                if attempt == retries:
+                    raise
+                METRICS.inc('llm_retries_total', call=call)
+                await asyncio.sleep(backoff * 2 ** attempt * (1 + random.random() / 4))
+
+
+def explanation_prompt(model_prediction, confidence):
+    prompt = f"""You are an expert neurologist. You are tasked with explaining a saliency map of a brain tumor MRI scan.
+    The saliency map was generated by a deep learning model that was trained to classify brain tumors
+    as either glioma, meningioma, pituitary, or no tumor.
+
+    The saliency map highlights the regions of the image that the machine learning model is focusing on to make the prediction.
+
+    The deep learning model predicted the image to be of class '{model_prediction}' with a confidence of {confidence * 100}%.
+
+    In your response:
+    – Explain what regions of the brain the model is focusing on, based on the saliency map. Refer to the regions highlighted
+    in light cyan, those are the regions where the model is focusing on.
+    – Explain possible reasons why the model made the prediction it did.
+    – Don’t mention anything like "The saliency map highlights the regions the model is focusing on, which are in light cyan"
+    in your explanation.
+    – Keep your explanation to 4 sentences max.
+
+    Let's think step by step about this. Verify step by step.
+    """
+    return prompt
+
+
+def chat_prompt(user_question, user_type, model_prediction, confidence):
+    prompt = f"""You are an expert neurologist specializing in brain tumors. You have been asked to interpret and explain the results of an MRI scan.
+  The scan was classified by a deep learning model as one of four categories: glioma, meningioma, pituitary tumor, or no tumor.
+  The model predicts this MRI scan to be of class '{model_prediction}' with a confidence level of {confidence * 100}%.
+
+  The user is a {user_type} and has asked the following question: {user_question}.
+
+  When responding, keep the following in mind:
+
+  If the user is a patient, avoid medical jargon and provide an explanation that is clear and accessible to someone with no medical background. Keep it simple and reassuring.
+  Do not adopt a formal doctor's role; just provide information based on the question without suggesting appointments, further steps, or treatment options.
+  Use a step-by-step approach in your response to ensure clarity and thoroughness.
+  Be brief in your responses.
+
+  Let's think step by step about this. Verify step by step.
+
+  """
+    return prompt
+
+
+async def generate_explanation_gemini(img, model_prediction, confidence):
+    provider = get_provider("gemini")
+    return await call_with_retry(provider.generate, [explanation_prompt(model_prediction, confidence), img], call='explanation_gemini')
+
+
+async def generate_explanation_pixtral(img, model_prediction, confidence):
+    provider = get_provider("pixtral")
+    return await call_with_retry(provider.generate, [explanation_prompt(model_prediction, confidence), img], call='explanation_pixtral')
+
+
+async def stream_with_retry(provider, contents, call='chat', timeout=DEFAULT_TIMEOUT):
+    start = time.perf_counter()
+
+    async def open_stream():
+        chunks = provider.stream(contents).__aiter__()
+        try:
+            return await chunks.__anext__(), chunks
+        except StopAsyncIteration:
+            return None, None
+
+    # Only opening the stream (up to the first chunk) is retried; a stream
+    # that fails midway surfaces the error rather than repeating text the
+    # user has already seen.
+    first, chunks = await call_with_retry(open_stream, call=f'{call}_first_token', timeout=timeout)
+    METRICS.observe('llm_time_to_first_token_seconds', time.perf_counter() - start, call=call)
+    if chunks is None:
+        return
+    yield first
+    while True:
+        try:
+            chunk = await asyncio.wait_for(chunks.__anext__(), timeout)
+        except StopAsyncIteration:
+            METRICS.observe('llm_seconds', time.perf_counter() - start, call=call)
+            return
+        yield chunk
+
+
+async def generate_chat_response_gemini(user_question, user_type, model_prediction, confidence, img, timeout=DEFAULT_TIMEOUT):
+    prompt = chat_prompt(user_question, user_type, model_prediction, confidence)
+    async for chunk in stream_with_retry(get_provider("gemini"), [prompt, img], timeout=timeout):
+        yield chunk
+
+
+class _LoopThread:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="llm-loop", daemon=True)
+        self.thread.start()
+
+
+_loop_thread = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop():
+    global _loop_thread
+    with _loop_lock:
+        if _loop_thread is None:
+            _loop_thread = _LoopThread()
+        return _loop_thread.loop
+
+
+def submit(coro):
+    """Schedule `coro` on the shared LLM event loop.
+
+    Returns a concurrent.futures.Future; cancelling it cancels the underlying
+    request.
+    """
+    return asyncio.run_coroutine_threadsafe(bind_trace(coro), _get_loop())
+
+
+def run(coro, timeout=None):
+    return submit(coro).result(timeout)
+
+
+def iterate(async_iterable):
+    # Drive an async generator from synchronous code (e.g. a Streamlit
+    # script), one item at a time.
+    iterator = async_iterable.__aiter__()
+
+    async def _next():
+        return await iterator.__anext__()
+
+    while True:
+        try:
+            yield run(_next())
+        except StopAsyncIteration:
+            return
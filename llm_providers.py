@@ -0,0 +1,171 @@
+import asyncio
+import hashlib
+import io
+import os
+import threading
+
+GEMINI_MODEL = "gemini-1.5-flash"
+PIXTRAL_MODEL = "pixtral-12b-2409"
+
+
+class LLMProvider:
+    """A text-generation backend the explanation and chat calls go through.
+
+    `contents` is a list of prompt strings and images, as accepted by
+    Gemini's `generate_content`.
+    """
+
+    name = None
+
+    async def generate(self, contents):
+        raise NotImplementedError
+
+    async def stream(self, contents):
+        yield await self.generate(contents)
+
+    async def upload(self, img):
+        # A reference to `img` that later `contents` can carry instead of the
+        # image itself. Providers without file storage send it inline.
+        return img
+
+    async def delete(self, ref):
+        # Frees what `upload` stored for `ref`; nothing to do when it was
+        # never stored.
+        return None
+
+
+class GeminiProvider(LLMProvider):
+    name = "gemini"
+
+    def __init__(self, api_key=None, model_name=GEMINI_MODEL):
+        import google.generativeai as genai
+
+        if api_key:
+            genai.configure(api_key=api_key)
+        self.model = genai.GenerativeModel(model_name=model_name)
+
+    async def generate(self, contents):
+        response = await self.model.generate_content_async(contents)
+        return response.text
+
+    async def stream(self, contents):
+        response = await self.model.generate_content_async(contents, stream=True)
+        async for chunk in response:
+            yield chunk.text
+
+    async def upload(self, img):
+        # Stored through the File API once; each request then only sends the
+        # file's URI.
+        import google.generativeai as genai
+
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG")
+        buffer.seek(0)
+        return await asyncio.to_thread(genai.upload_file, buffer, mime_type="image/png")
+
+    async def delete(self, ref):
+        # Uploaded files otherwise stay in the project's storage until they
+        # expire, counting against its quota.
+        import google.generativeai as genai
+
+        await asyncio.to_thread(genai.delete_file, ref.name)
+
+
+class PixtralProvider(LLMProvider):
+    name = "pixtral"
+
+    def __init__(self, api_key=None, model_name=PIXTRAL_MODEL):
+        from mistralai import Mistral
+
+        self.client = Mistral(api_key=api_key)
+        self.model_name = model_name
+
+    async def generate(self, contents):
+        # Only the text parts are sent, as before.
+        prompt = "\n".join(part for part in contents if isinstance(part, str))
+        chat_response = await self.client.chat.complete_async(
+            model=self.model_name,
+            messages=[
+                {
+                    "role": "user",
+                    "content": prompt,
+                },
+            ]
+        )
+        return chat_response.choices[0].message.content
+
+
+class LocalProvider(LLMProvider):
+    """Deterministic offline stand-in for benchmarks and load tests.
+
+    Responses are derived from a hash of the prompt text, so the same inputs
+    always produce the same output. `latency` is the delay before the first
+    token and `tokens_per_second` paces the rest of the response (0 means
+    no pacing).
+    """
+
+    name = "local"
+
+    WORDS = ("the", "model", "focuses", "on", "a", "region", "near", "the", "left", "temporal", "lobe",
+             "with", "high", "contrast", "consistent", "with", "the", "predicted", "class", "and",
+             "surrounding", "tissue", "appears", "within", "normal", "limits")
+
+    def __init__(self, latency=0.0, tokens_per_second=0.0, response_tokens=60):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+
+    def _tokens(self, contents):
+        prompt = "\n".join(part for part in contents if isinstance(part, str))
+        seed = hashlib.sha256(prompt.encode()).digest()
+        return [self.WORDS[seed[i % len(seed)] % len(self.WORDS)] + " " for i in range(self.response_tokens)]
+
+    async def stream(self, contents):
+        tokens = self._tokens(contents)
+        await asyncio.sleep(self.latency)
+        for i, token in enumerate(tokens):
+            if i and self.tokens_per_second:
+                await asyncio.sleep(1.0 / self.tokens_per_second)
+            yield token
+
+    async def generate(self, contents):
+        return "".join([token async for token in self.stream(contents)])
+
+
+_PROVIDER_TYPES = {
+    GeminiProvider.name: GeminiProvider,
+    PixtralProvider.name: PixtralProvider,
+    LocalProvider.name: LocalProvider,
+}
+
+_keys = {}
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def configure(google_api_key=None, pixtral_api_key=None):
+    _keys[GeminiProvider.name] = google_api_key
+    _keys[PixtralProvider.name] = pixtral_api_key
+
+
+def set_provider(name, provider):
+    # Route every call for `name` ("gemini" or "pixtral") to `provider`.
+    with _providers_lock:
+        _providers[name] = provider
+
+
+def get_provider(name):
+    """The shared provider for `name`, created on first use.
+
+    Setting the LLM_PROVIDER environment variable to "local" routes every
+    name to the offline stand-in.
+    """
+    with _providers_lock:
+        provider = _providers.get(name)
+        if provider is None:
+            if os.getenv("LLM_PROVIDER") == LocalProvider.name or name == LocalProvider.name:
+                provider = LocalProvider()
+            else:
+                provider = _PROVIDER_TYPES[name](api_key=_keys.get(name))
+            _providers[name] = provider
+        return provider
@@ -0,0 +1,190 @@
+import contextvars
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+MAX_TRACES = 100
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Trace:
+    """Timed spans for one request, e.g. one upload in the app."""
+
+    def __init__(self, name, **labels):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.labels = labels
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.spans = []
+        self.duration = None
+
+    def add_span(self, name, start, duration, **labels):
+        self.spans.append({'name': name, 'offset': start - self._start, 'duration': duration, **labels})
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start
+
+    def to_dict(self):
+        return {'id': self.id, 'name': self.name, 'labels': self.labels, 'started': self.started,
+                'duration': self.duration, 'spans': list(self.spans)}
+
+
+class Metrics:
+    """Process-wide counters and latency histograms.
+
+    `timer` records a duration into a histogram and, when a trace is active in
+    the current context, into that trace as a span. Everything is exposed as
+    Prometheus text (`prometheus_text`) or JSON (`to_dict`).
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._traces = deque(maxlen=MAX_TRACES)
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(self.buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.observe(name, duration, **labels)
+            trace = _current_trace.get()
+            if trace is not None:
+                trace.add_span(name, start, duration, **labels)
+
+    def start_trace(self, name, **labels):
+        # Returns the token to pass to `finish_trace`.
+        return _current_trace.set(Trace(name, **labels))
+
+    def finish_trace(self, token):
+        trace = _current_trace.get()
+        _current_trace.reset(token)
+        if trace is not None:
+            trace.finish()
+            with self._lock:
+                self._traces.append(trace)
+        return trace
+
+    def traces(self):
+        with self._lock:
+            return [trace.to_dict() for trace in self._traces]
+
+    def to_dict(self):
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels), 'count': h.count, 'sum': h.sum,
+                           'buckets': dict(zip([str(b) for b in h.buckets] + ['+Inf'], h.counts))}
+                          for (name, labels), h in sorted(self._histograms.items())]
+        return {'counters': counters, 'histograms': histograms}
+
+    def prometheus_text(self):
+        def fmt(labels, **extra):
+            items = list(labels) + list(extra.items())
+            if not items:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f'# TYPE {name} counter')
+                for (metric, labels), value in sorted(self._counters.items()):
+                    if metric == name:
+                        lines.append(f'{name}{fmt(labels)} {value}')
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (metric, labels), h in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(list(h.buckets) + ['+Inf'], h.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{fmt(labels, le=bound)} {cumulative}')
+                    lines.append(f'{name}_sum{fmt(labels)} {h.sum}')
+                    lines.append(f'{name}_count{fmt(labels)} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+def bind_trace(coro):
+    # Coroutines scheduled onto another thread's event loop don't inherit the
+    # caller's context; carry the active trace over explicitly.
+    trace = _current_trace.get()
+
+    async def bound():
+        _current_trace.set(trace)
+        return await coro
+    return bound()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = METRICS.prometheus_text().encode(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(METRICS.to_dict()).encode(), 'application/json'
+        elif self.path == '/traces':
+            body, content_type = json.dumps(METRICS.traces()).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host='0.0.0.0'):
+    """Serve /metrics (Prometheus), /metrics.json and /traces from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
@@ -0,0 +1,226 @@
+import hashlib
+import os
+import threading
+from dataclasses import dataclass
+from typing import Callable, Tuple
+
+import tensorflow as tf
+from tensorflow.keras.models import Sequential, load_model
+from tensorflow.keras import regularizers
+from tensorflow.keras.layers import Conv2D, Dense, Dropout, Flatten, Input, MaxPooling2D
+from tensorflow.keras.optimizers import Adamax
+from tensorflow.keras.metrics import Precision, Recall
+
+from metrics import METRICS
+
+LABELS = ['Glioma', 'Meningioma', 'No tumor', 'Pituitary']
+
+XCEPTION = "Transfer Learning - Xception"
+CUSTOM_CNN = "Custom CNN"
+
+# Short names for the command lines and the HTTP API.
+MODELS = {'xception': XCEPTION, 'cnn': CUSTOM_CNN}
+
+
+def build_xception_model(base_weights=None):
+  # The fine-tuned weight file covers the base model too, so ImageNet
+  # weights are only worth downloading when training from scratch.
+  img_shape = (299, 299, 3)
+  base_model = tf.keras.applications.Xception(include_top=False, weights=base_weights, input_shape=img_shape, pooling='max')
+
+  model = Sequential([
+      base_model,
+      Flatten(),
+      Dropout(rate=0.3),
+      Dense(128, activation='relu'),
+      Dropout(rate=0.25),
+      # float32 even under a mixed precision policy, so training keeps a
+      # numerically stable softmax; a no-op for float32 models.
+      Dense(4, activation='softmax', dtype='float32')
+  ])
+
+  model.build((None,) + img_shape)
+
+  model.compile(Adamax(learning_rate=0.01),
+                loss="categorical_crossentropy",
+                metrics=['accuracy', Precision(), Recall()])
+
+  return model
+
+
+def build_cnn_model():
+  img_shape = (224, 224, 3)
+  cnn_model = Sequential()
+  cnn_model.add(Input(shape=img_shape))
+  cnn_model.add(Conv2D(256, (3, 3), padding='same', activation='relu'))
+  cnn_model.add(MaxPooling2D(pool_size=(2, 2)))
+  cnn_model.add(Conv2D(128, (3,3), padding='same', activation='relu'))
+  cnn_model.add(MaxPooling2D(pool_size=(2, 2)))
+  cnn_model.add(Dropout(0.20))
+  cnn_model.add(Conv2D(64, (3,3), padding='same', activation='relu'))
+  cnn_model.add(MaxPooling2D(pool_size=(2, 2)))
+  cnn_model.add(Flatten())
+  cnn_model.add(Dense(256, activation='relu', kernel_regularizer=regularizers.l2(0.01)))
+  cnn_model.add(Dropout(0.35))
+  cnn_model.add(Dense(4, activation='softmax', dtype='float32'))
+
+  cnn_model.compile(
+      Adamax(learning_rate=0.001),
+      loss='categorical_crossentropy',
+      metrics=[
+          'accuracy',
+          Precision(name='precision'),
+          Recall(name='recall')
+      ]
+  )
+
+  return cnn_model
+
+
+def load_xception_model(path):
+  model = build_xception_model()
+  model.load_weights(path)
+
+  return model
+
+
+def load_cnn_model(path):
+  return load_model(path)
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    name: str
+    path: str
+    img_size: Tuple[int, int]
+    loader: Callable
+    builder: Callable = None
+
+
+MODEL_SPECS = {
+    XCEPTION: ModelSpec(XCEPTION, 'trained_xception_model.weights.h5', (299, 299), load_xception_model, build_xception_model),
+    CUSTOM_CNN: ModelSpec(CUSTOM_CNN, 'trained_cnn_model.h5', (224, 224), load_cnn_model, build_cnn_model),
+}
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+_digests = {}
+
+
+def file_sha256(path):
+    # Hex SHA-256 of a file's contents, or None if it is missing. Hashed once
+    # per (path, size, mtime), so asking again after the first read is a stat.
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    digest = _digests.get(key)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        digest = _digests[key] = sha.hexdigest()
+    return digest
+
+
+@dataclass
+class _Entry:
+    model: object
+    path: str
+    mtime: float
+
+
+class ModelRegistry:
+    """Loads each model once per process and shares it between sessions.
+
+    A model is rebuilt only when its weight file changes on disk or when a new
+    file is swapped in with `swap`, so Streamlit reruns never pay for model
+    construction.
+    """
+
+    def __init__(self, specs=None):
+        self._specs = dict(specs or MODEL_SPECS)
+        self._entries = {}
+        self._locks = {name: threading.Lock() for name in self._specs}
+
+    def spec(self, name):
+        return self._specs[name]
+
+    def get(self, name):
+        return self._get(name, name, lambda: self._specs[name].path, self._specs[name].loader)
+
+    def get_tflite(self, name):
+        # The exported TFLite file next to the weight file, loaded and
+        # reloaded on change like the Keras model.
+        from tflite_backend import TFLiteModel, tflite_path
+
+        return self._get(name, (name, 'tflite'), lambda: tflite_path(self._specs[name].path), TFLiteModel)
+
+    def _get(self, name, key, path_of, loader):
+        path = path_of()
+        entry = self._entries.get(key)
+        if entry is not None and entry.path == path and entry.mtime == _mtime(path):
+            return entry.model
+
+        with self._locks[name]:
+            # Another thread may have finished loading (or swapped in a new
+            # file) while we waited.
+            path = path_of()
+            entry = self._entries.get(key)
+            mtime = _mtime(path)
+            if entry is None or entry.path != path or entry.mtime != mtime:
+                with METRICS.timer('model_load_seconds', model=name):
+                    entry = _Entry(loader(path), path, mtime)
+                self._entries[key] = entry
+            return entry.model
+
+    def model_id(self, name, backend='keras'):
+        spec = self._specs[name]
+        path = spec.path
+        if backend == 'tflite':
+            from tflite_backend import tflite_path
+
+            path = tflite_path(path)
+        entry = self._entries.get(name if backend == 'keras' else (name, backend))
+        mtime = entry.mtime if entry is not None and entry.path == path else _mtime(path)
+        return f"{name}@{os.path.basename(path)}:{int(mtime or 0)}"
+
+    def weights_sha256(self, name):
+        # Identifies the weights by content: unlike model_id, copying or
+        # touching the file does not change it.
+        return file_sha256(self._specs[name].path)
+
+    def swap(self, name, path):
+        # Build the replacement before publishing it so in-flight requests keep
+        # using the old model, and a bad file leaves the old one in service.
+        spec = self._specs[name]
+        with METRICS.timer('model_load_seconds', model=name):
+            model = spec.loader(path)
+        with self._locks[name]:
+            self._specs[name] = ModelSpec(spec.name, path, spec.img_size, spec.loader, spec.builder)
+            self._entries[name] = _Entry(model, path, _mtime(path))
+        return model
+
+    def warm(self, names=None):
+        for name in names or self._specs:
+            self.get(name)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry()
+        return _registry
@@ -0,0 +1,159 @@
+import io
+import time
+
+import cv2
+import numpy as np
+
+from ensemble import ENSEMBLE, Ensemble
+from inference_engine import get_engine
+from metrics import METRICS
+from model_registry import LABELS, XCEPTION, get_registry
+from preprocessing import decode_image
+from result_cache import image_digest, make_cache_key
+from saliency import INPUT_GRADIENTS, classify_and_explain
+from similar_cases import find_similar_cases
+
+
+def encode_png(img):
+    _, png = cv2.imencode('.png', cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+    return png.tobytes()
+
+
+def summarize(probabilities):
+    class_index = int(np.argmax(probabilities))
+    return {
+        'label': LABELS[class_index],
+        'confidence': float(probabilities[class_index]),
+        'probabilities': {label: float(p) for label, p in zip(LABELS, probabilities)},
+    }
+
+
+class Pipeline:
+    """The classify -> saliency -> similar cases steps for one scan.
+
+    The app and the HTTP API both go through it. `model` is a registered
+    model's name or an `Ensemble`, whose class is explained through Xception.
+    Results are shared through `cache` (a ResultCache): the scan's image and
+    probabilities under `cache_key(image_bytes, model)`, its saliency map
+    under the method's key, so a scan classified by one client is free for
+    the others. Each classification actually computed is recorded in `audit`
+    (an AuditStore).
+    """
+
+    def __init__(self, cache=None, backend='keras', registry=None, audit=None, source='api'):
+        self.cache = cache
+        self.backend = backend
+        self.registry = registry or get_registry()
+        self.audit = audit
+        self.source = source
+
+    def _model_id(self, model):
+        if isinstance(model, Ensemble):
+            return model.model_id()
+        return self.registry.model_id(model, self.backend)
+
+    def _explained_model(self, model):
+        return XCEPTION if isinstance(model, Ensemble) else model
+
+    def cache_key(self, image_bytes, model, method=INPUT_GRADIENTS):
+        # Each saliency method gets its own entry, so explanations and reports
+        # cached for one map are never served for another.
+        model_id = self._model_id(model)
+        if method != INPUT_GRADIENTS:
+            model_id += f'#{method}'
+        return make_cache_key(image_bytes, model_id)
+
+    def _cached(self, key):
+        entry = self.cache.get(key) if self.cache is not None else None
+        METRICS.inc('result_cache_requests_total', result='miss' if entry is None else 'hit')
+        return entry or {}
+
+    def _update(self, key, **fields):
+        if self.cache is not None:
+            self.cache.update(key, **fields)
+
+    def _record(self, image_bytes, model, probabilities, key, method=None, **latencies):
+        if self.audit is not None:
+            self.audit.record(image_digest(image_bytes), ENSEMBLE if isinstance(model, Ensemble) else model,
+                              probabilities, model_version=self._model_id(model), latencies=latencies,
+                              artifacts={'cache_key': key}, source=self.source, backend=self.backend,
+                              saliency_method=method)
+
+    def _image(self, cached, image_bytes, model):
+        # The scan is decoded once per cache entry; classify and saliency
+        # requests for it share the uint8 buffer.
+        if 'image' not in cached:
+            img_size = self.registry.spec(self._explained_model(model)).img_size
+            cached['image'] = decode_image(io.BytesIO(image_bytes), img_size)
+        return cached['image'][np.newaxis]
+
+    def entry(self, image_bytes, model):
+        # Everything cached for the scan: its decoded image, probabilities,
+        # similar cases and, for an ensemble, each member's probabilities.
+        return self._cached(self.cache_key(image_bytes, model))
+
+    def classify(self, image_bytes, model):
+        key = self.cache_key(image_bytes, model)
+        cached = self._cached(key)
+        if 'probabilities' not in cached:
+            start = time.perf_counter()
+            if isinstance(model, Ensemble):
+                # Both members run at once, each on its own input size from
+                # the same decode.
+                images = model.decode(io.BytesIO(image_bytes))
+                ensembled = model.predict(images)
+                cached.update(image=images[XCEPTION], probabilities=ensembled.probabilities,
+                              per_model=ensembled.per_model, agree=ensembled.agree)
+            else:
+                img_array = self._image(cached, image_bytes, model)
+                if self.backend == 'tflite':
+                    cached['probabilities'] = self.registry.get_tflite(model).predict(img_array)
+                else:
+                    # Concurrent requests are batched together by the engine.
+                    cached['probabilities'] = get_engine(model, self.registry).predict(img_array)
+            self._update(key, **cached)
+            self._record(image_bytes, model, cached['probabilities'][0], key, classify=time.perf_counter() - start)
+        return cached['probabilities'][0]
+
+    def saliency(self, image_bytes, model, method=INPUT_GRADIENTS):
+        base_key = self.cache_key(image_bytes, model)
+        key = self.cache_key(image_bytes, model, method)
+        cached = self._cached(key)
+        if 'saliency_map' in cached:
+            return self.classify(image_bytes, model), cached['saliency_map']
+
+        # TFLite's and the ensemble's classes come from classify(); the map
+        # then explains that class. A Keras model's saliency pass classifies
+        # the scan itself.
+        if self.backend == 'tflite' or isinstance(model, Ensemble):
+            probabilities = self.classify(image_bytes, model)
+        else:
+            probabilities = None
+        base = self._cached(base_key)
+        if probabilities is None and 'probabilities' in base:
+            probabilities = base['probabilities'][0]
+        start = time.perf_counter()
+        img_array = self._image(base, image_bytes, model)
+        class_indices = [int(np.argmax(probabilities))] if probabilities is not None else None
+        explained = classify_and_explain(self.registry.get(self._explained_model(model)), img_array, class_indices,
+                                         method=method)
+        saliency_map = explained.saliency_maps()[0]
+        self._update(key, saliency_map=saliency_map)
+        if probabilities is None:
+            # A scan first seen here is classified by the saliency pass.
+            probabilities = explained.probabilities[0]
+            self._update(base_key, image=base['image'], probabilities=explained.probabilities)
+            self._record(image_bytes, model, probabilities, base_key, method,
+                         saliency=time.perf_counter() - start)
+        return probabilities, saliency_map
+
+    def similar_cases(self, image_bytes, model):
+        # Descriptions of the nearest labeled scans, for the report.
+        key = self.cache_key(image_bytes, model)
+        cached = self._cached(key)
+        if 'similar_cases' not in cached:
+            img_array = self._image(cached, image_bytes, model)
+            cases = find_similar_cases(img_array, registry=self.registry, sources=[io.BytesIO(image_bytes)])[0]
+            cached['similar_cases'] = [case.describe() for case in cases]
+            self._update(key, similar_cases=cached['similar_cases'])
+        return cached['similar_cases']
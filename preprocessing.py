@@ -0,0 +1,37 @@
+import numpy as np
+import PIL.Image
+import tensorflow as tf
+
+from metrics import METRICS
+
+
+def decode_image(path_or_file, img_size):
+    """Decode a scan once into an `(H, W, 3)` uint8 array at the model's size.
+
+    This is the one buffer an upload needs: models take it as is and
+    normalize on-graph (`normalize`), and the saliency overlay and the
+    display use the same pixels. Matches keras' `load_img(target_size=...)`.
+    """
+    return decode_images(path_or_file, [img_size])[tuple(img_size)]
+
+
+def decode_images(path_or_file, img_sizes):
+    # One decode, resized to each of `img_sizes`; returns {img_size: array}.
+    with METRICS.timer('decode_seconds'), PIL.Image.open(path_or_file) as img:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        arrays = {}
+        for height, width in img_sizes:
+            resized = img if img.size == (width, height) else img.resize((width, height), PIL.Image.NEAREST)
+            arrays[(height, width)] = np.asarray(resized)
+        return arrays
+
+
+def normalize(img_batch):
+    # uint8 pixels -> the [0, 1] float32 input the models were trained on.
+    return tf.cast(img_batch, tf.float32) / 255.0
+
+
+def load_image_array(path_or_file, img_size):
+    # Float [0, 1] copy for callers that need the normalized array on the host.
+    return decode_image(path_or_file, img_size).astype(np.float32) / 255.0
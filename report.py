@@ -0,0 +1,124 @@
+import datetime
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+from fpdf import FPDF
+from fpdf.enums import XPos, YPos
+
+from metrics import METRICS
+
+RECOMMENDATIONS = (
+    "1. Consult a neurologist or medical professional for confirmation.\n"
+    "2. Bring this report to your doctor's appointment for a more informed discussion.\n"
+    "3. Follow your doctor's advice for further diagnostic tests or treatment options.\n"
+    "4. Maintain a healthy lifestyle, including regular check-ups, to monitor your brain health."
+)
+
+DISCLAIMER = (
+    "This report is generated for informational purposes only and must not replace a doctor's consultation. "
+    "The predictions made by this app are based on a deep learning model and should not be considered a definitive diagnosis. "
+    "We strongly recommend consulting a qualified medical professional for confirmation and further guidance."
+    " The similar cases listed here are the labeled dataset scans that look most alike to the model, not patient histories."
+)
+
+# Where the cursor goes after a cell: the start of the next line.
+NEXT_LINE = {'new_x': XPos.LMARGIN, 'new_y': YPos.NEXT}
+
+# The fixed sections that close every report, (heading, text) in page order.
+STATIC_SECTIONS = (
+    ("General Recommendations:", RECOMMENDATIONS),
+    ("Cautionary Disclaimer:", DISCLAIMER),
+)
+
+
+class ReportPDF(FPDF):
+    def header(self):
+        self.set_font("helvetica", "B", 12)
+        self.cell(0, 10, "Brain Tumor Classification App", align="C", **NEXT_LINE)
+
+    def footer(self):
+        self.set_y(-15)
+        self.set_font("helvetica", "I", 8)
+        self.cell(0, 10, "Made by Dawit Zewdu @ December 2024", align="C")
+
+    def section(self, heading, *paragraphs):
+        self.set_font("helvetica", "B", 12)
+        self.cell(0, 10, heading, **NEXT_LINE)
+        self.set_font("helvetica", size=12)
+        for text in paragraphs:
+            self.multi_cell(0, 10, text, **NEXT_LINE)
+        self.ln(10)
+
+
+def _png(img):
+    # The RGB uint8 overlay as PNG bytes, embedded from memory.
+    return io.BytesIO(cv2.imencode('.png', cv2.cvtColor(img, cv2.COLOR_RGB2BGR))[1].tobytes())
+
+
+def create_pdf_report(prediction, confidence, result, saliency_map, explanation, cases):
+    """Render the downloadable report and return the PDF as bytes.
+
+    `saliency_map` is the RGB uint8 overlay; everything the report shows
+    besides its fixed sections is passed in explicitly.
+    """
+    with METRICS.timer('report_seconds'):
+        return _render_pdf_report(prediction, confidence, result, saliency_map, explanation, cases)
+
+
+def _render_pdf_report(prediction, confidence, result, saliency_map, explanation, cases):
+    pdf = ReportPDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.add_page()
+
+    # Title
+    pdf.set_font("helvetica", "B", 16)
+    pdf.cell(0, 10, "Brain Tumor Classification Report", align="C", **NEXT_LINE)
+    pdf.ln(10)
+
+    # Add Prediction Summary
+    pdf.set_font("helvetica", size=12)
+    pdf.cell(0, 10, f"Date: {datetime.datetime.now().strftime('%Y-%m-%d')}", **NEXT_LINE)
+    pdf.cell(0, 10, f"Predicted Class: {result}", **NEXT_LINE)
+    pdf.cell(0, 10, f"Confidence: {confidence * 100:.2f}%", **NEXT_LINE)
+    pdf.ln(10)
+
+    # Add Saliency Map
+    pdf.set_font("helvetica", "B", 12)
+    pdf.cell(0, 10, "Saliency Map:", **NEXT_LINE)
+    pdf.image(_png(saliency_map), x=50, w=100)  # Adjust size and positioning
+    pdf.ln(10)
+
+    pdf.section("Explanation:", explanation)
+    # Nearest labeled scans, see similar_cases.py
+    pdf.section("Similar Labeled Cases:", *(cases or ["No similar-case index is available."]))
+    for heading, text in STATIC_SECTIONS:
+        pdf.section(heading, text)
+
+    # Return the PDF as bytes instead of a shared file on disk
+    return bytes(pdf.output())
+
+
+def _render_job(job):
+    return create_pdf_report(**job)
+
+
+def report_pool(max_workers=None):
+    # Workers are spawned rather than forked: a forked copy of a process
+    # running TensorFlow can deadlock, and rendering only needs this module.
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def render_reports(jobs, max_workers=None, executor=None):
+    """Render many reports in a process pool; yields PDF bytes in job order.
+
+    Each job is a dict of `create_pdf_report` keyword arguments. Pass a
+    long-lived `executor` (see `report_pool`) to reuse its worker processes
+    across calls.
+    """
+    if executor is not None:
+        yield from executor.map(_render_job, jobs)
+        return
+    with report_pool(max_workers) as executor:
+        yield from executor.map(_render_job, jobs)
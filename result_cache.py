@@ -0,0 +1,119 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 128
+DEFAULT_MAX_DISK_BYTES = 512 * 1024 * 1024
+
+
+def image_digest(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def make_cache_key(image_bytes, model_id):
+    digest = image_digest(image_bytes)
+    model_digest = hashlib.sha256(model_id.encode()).hexdigest()[:16]
+    return f"{digest}-{model_digest}"
+
+
+class ResultCache:
+    """Per-scan results keyed by image hash and model identity.
+
+    Entries are dicts of artifacts (probabilities, saliency overlay,
+    explanations, report bytes, ...). The in-memory tier is an LRU bounded by
+    entry count; the optional disk tier in `disk_dir` survives restarts and
+    evicts least recently used files once it grows past `max_disk_bytes`.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, disk_dir=None, max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        # Reentrant: update() holds it across its own get() and put().
+        self._lock = threading.RLock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return dict(entry)
+
+        entry = self._read_disk(key)
+        if entry is not None:
+            self._remember(key, entry)
+            return dict(entry)
+        return None
+
+    def put(self, key, entry):
+        entry = dict(entry)
+        self._remember(key, entry)
+        self._write_disk(key, entry)
+        return dict(entry)
+
+    def update(self, key, **fields):
+        # Read, merge and write under one lock, so concurrent updates of the
+        # same key (say a saliency map and an explanation) both land.
+        with self._lock:
+            entry = self.get(key) or {}
+            entry.update(fields)
+            return self.put(key, entry)
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.pkl")
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            # The file's mtime doubles as its last-used time for eviction.
+            os.utime(path)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        return entry
+
+    def _write_disk(self, key, entry):
+        if not self.disk_dir:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._disk_path(key))
+        self._evict_disk()
+
+    def _evict_disk(self):
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith('.pkl'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.disk_dir, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.disk_dir, name))
+            except OSError:
+                pass
+            total -= size
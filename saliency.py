@@ -0,0 +1,242 @@
+import functools
+import weakref
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+from metrics import METRICS
+from preprocessing import normalize
+
+# cv2 filters and resizes at most CV_CN_MAX (128) channels per call; batches
+# are processed as multi-channel images in chunks of this size.
+_MAX_CV_CHANNELS = 128
+
+# Saliency methods, by the name callers pass as `method`.
+INPUT_GRADIENTS = 'gradients'
+GRAD_CAM = 'gradcam'
+GRAD_CAM_PLUS_PLUS = 'gradcam-pp'
+METHODS = {
+    INPUT_GRADIENTS: "Input gradients",
+    GRAD_CAM: "Grad-CAM",
+    GRAD_CAM_PLUS_PLUS: "Grad-CAM++",
+}
+
+_cam_splits = weakref.WeakKeyDictionary()
+
+
+@functools.lru_cache(maxsize=None)
+def circular_mask(img_size):
+    height, width = img_size
+    center = (height // 2, width // 2)
+    radius = min(center[0], center[1]) - 10
+    y, x = np.ogrid[:height, :width]
+    mask = (x - center[0])** 2 + (y - center[1])** 2 <= radius**2
+    mask.setflags(write=False)
+    return mask
+
+
+@functools.lru_cache(maxsize=None)
+def _jet_lut():
+    lut = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(-1, 1), cv2.COLORMAP_JET)
+    lut = cv2.cvtColor(lut, cv2.COLOR_BGR2RGB).reshape(256, 3)
+    lut.setflags(write=False)
+    return lut
+
+
+def _apply(layers, x):
+    for layer in layers:
+        x = layer(x, training=False)
+    return x
+
+
+def cam_split(model):
+    """`(features, head)` callables around the model's last conv feature map.
+
+    For the Xception model that is the base model's final conv block, just
+    before its max pooling; for the custom CNN, the last Conv2D.
+    `head(features(x))` equals `model(x)`. `features` is never differentiated,
+    so it is compiled into one graph for any batch size.
+    """
+    split = _cam_splits.get(model)
+    if split is None:
+        first = model.layers[0]
+        if isinstance(first, tf.keras.Model):
+            feature_model = tf.keras.Model(first.inputs, first.layers[-2].output)
+            feature_fn = lambda x: feature_model(x, training=False)
+            head_layers = [first.layers[-1]] + model.layers[1:]
+        else:
+            last_conv = max(i for i, layer in enumerate(model.layers) if isinstance(layer, tf.keras.layers.Conv2D))
+            feature_layers, head_layers = model.layers[:last_conv + 1], model.layers[last_conv + 1:]
+            feature_fn = lambda x: _apply(feature_layers, x)
+        signature = [tf.TensorSpec(shape=(None,) + tuple(model.inputs[0].shape[1:]), dtype=tf.float32)]
+        split = _cam_splits[model] = (tf.function(feature_fn, input_signature=signature),
+                                      lambda x: _apply(head_layers, x))
+    return split
+
+
+class ClassifyAndExplain:
+    """Probabilities and saliency gradients from one taped forward pass.
+
+    The gradients are computed on first access of `gradients`. Until then the
+    tape keeps the forward activations alive, so drop the object (or read
+    `gradients`) once the saliency panel no longer needs them. With the CAM
+    methods the gradients are taken at the last conv feature map instead of
+    the input pixels.
+    """
+
+    def __init__(self, probabilities, class_indices, tape, img_tensor, target_class, original_imgs=None,
+                 method=INPUT_GRADIENTS, feature_maps=None):
+        self.probabilities = probabilities
+        self.class_indices = class_indices
+        self.method = method
+        self._tape = tape
+        self._img_tensor = img_tensor
+        self._feature_maps = feature_maps
+        self._original_imgs = original_imgs
+        self._target_class = target_class
+        self._gradients = None
+
+    @property
+    def gradients(self):
+        # `(N, H, W)` max |input gradient| per pixel, or for the CAM methods
+        # the `(N, h, w, C)` gradients of the feature maps.
+        if self._gradients is None:
+            with METRICS.timer('saliency_seconds', phase='gradient', method=self.method):
+                if self.method == INPUT_GRADIENTS:
+                    gradients = self._tape.gradient(self._target_class, self._img_tensor)
+                    self._gradients = tf.reduce_max(tf.math.abs(gradients), axis=-1).numpy()
+                else:
+                    self._gradients = self._tape.gradient(self._target_class, self._feature_maps).numpy()
+            self._tape = self._target_class = None
+        return self._gradients
+
+    def saliency_maps(self, original_imgs=None):
+        if original_imgs is None:
+            original_imgs = self._original_imgs
+        if original_imgs is None:
+            original_imgs = self._img_tensor.numpy() * 255.0
+        gradients = self.gradients
+        with METRICS.timer('saliency_seconds', phase='postprocess', method=self.method):
+            if self.method == INPUT_GRADIENTS:
+                heatmaps = postprocess_gradients(gradients)
+            else:
+                cams = class_activation_maps(self._feature_maps.numpy(), gradients, self.method)
+                heatmaps = upsample_maps(cams, np.shape(original_imgs)[1:3])
+            return overlay_heatmaps(heatmaps, original_imgs)
+
+
+def classify_and_explain(model, img_batch, class_indices=None, lazy=False, method=INPUT_GRADIENTS):
+    # One forward/backward pass for the whole batch. Samples are independent
+    # at inference time, so the gradient of the summed targets gives every
+    # image the gradient of its own target class. Without `class_indices` the
+    # predicted class of each image is explained. A uint8 batch (from
+    # preprocessing.decode_image) is normalized here and reused as is for the
+    # overlay; a float batch is taken to be already in [0, 1]. `method` is
+    # one of METHODS.
+    if method not in METHODS:
+        raise ValueError(f"Unknown saliency method {method!r}, expected one of {sorted(METHODS)}")
+    original_imgs = None
+    if np.asarray(img_batch).dtype == np.uint8:
+        original_imgs = img_batch
+        img_tensor = normalize(img_batch)
+    else:
+        img_tensor = tf.convert_to_tensor(img_batch, dtype=tf.float32)
+    feature_maps = None
+    with METRICS.timer('predict_seconds', path='taped'), tf.GradientTape() as tape:
+        if method == INPUT_GRADIENTS:
+            tape.watch(img_tensor)
+            predictions = model(img_tensor, training=False)
+        else:
+            # Only the head is taped: the backward pass, and the activations
+            # kept alive for it, stop at the feature maps.
+            features, head = cam_split(model)
+            with tape.stop_recording():
+                feature_maps = features(img_tensor)
+            tape.watch(feature_maps)
+            predictions = head(feature_maps)
+        if class_indices is None:
+            class_indices = tf.argmax(predictions, axis=1, output_type=tf.int32)
+        else:
+            class_indices = tf.convert_to_tensor(np.asarray(class_indices).reshape(-1), dtype=tf.int32)
+        target_class = tf.gather(predictions, class_indices, axis=1, batch_dims=1)
+
+    result = ClassifyAndExplain(predictions.numpy(), class_indices.numpy(), tape, img_tensor, target_class,
+                                original_imgs, method, feature_maps)
+    if not lazy:
+        result.gradients
+    return result
+
+
+def _blur(gradients):
+    channels_last = np.ascontiguousarray(gradients.transpose(1, 2, 0))
+    blurred = np.empty_like(channels_last)
+    for start in range(0, channels_last.shape[-1], _MAX_CV_CHANNELS):
+        chunk = channels_last[..., start:start + _MAX_CV_CHANNELS]
+        blurred[..., start:start + _MAX_CV_CHANNELS] = cv2.GaussianBlur(chunk, (11, 11), 0).reshape(chunk.shape)
+    return blurred.transpose(2, 0, 1)
+
+
+def postprocess_gradients(gradients):
+    # Vectorized version of the per-image clean-up: mask to the brain, min-max
+    # normalize inside the mask, keep the top 20% and smooth.
+    gradients = np.array(gradients, dtype=np.float32)
+    mask = circular_mask(gradients.shape[1:3])
+    gradients *= mask
+
+    brain_gradients = gradients[:, mask]
+    low = brain_gradients.min(axis=1, keepdims=True)
+    high = brain_gradients.max(axis=1, keepdims=True)
+    scale = np.where(high > low, high - low, 1.0)
+    brain_gradients = np.where(high > low, (brain_gradients - low) / scale, brain_gradients)
+    gradients[:, mask] = brain_gradients
+
+    threshold = np.percentile(brain_gradients, 80, axis=1)
+    gradients[gradients < threshold[:, None, None]] = 0
+
+    return _blur(gradients)
+
+
+def class_activation_maps(feature_maps, gradients, method=GRAD_CAM):
+    # `(N, h, w)` maps from `(N, h, w, C)` feature maps and their gradients.
+    # Grad-CAM weights each channel by its mean gradient; Grad-CAM++ by
+    # positive gradients weighted with the closed-form alphas of Chattopadhay
+    # et al., which favours maps with several separate active regions.
+    if method == GRAD_CAM:
+        weights = gradients.mean(axis=(1, 2))
+    else:
+        grads_2, grads_3 = gradients ** 2, gradients ** 3
+        denominator = 2 * grads_2 + feature_maps.sum(axis=(1, 2), keepdims=True) * grads_3
+        alphas = grads_2 / np.where(denominator != 0, denominator, 1)
+        weights = (alphas * np.maximum(gradients, 0)).sum(axis=(1, 2))
+    cams = np.maximum(np.einsum('nhwc,nc->nhw', feature_maps, weights), 0)
+    high = cams.max(axis=(1, 2), keepdims=True)
+    return cams / np.where(high > 0, high, 1)
+
+
+def upsample_maps(maps, img_size):
+    # One bilinear resize of the coarse maps to the image size, all images at
+    # once (as channels, in chunks cv2 accepts).
+    channels_last = np.ascontiguousarray(maps.transpose(1, 2, 0), dtype=np.float32)
+    resized = np.empty(tuple(img_size) + (len(maps),), dtype=np.float32)
+    for start in range(0, len(maps), _MAX_CV_CHANNELS):
+        chunk = channels_last[..., start:start + _MAX_CV_CHANNELS]
+        resized[..., start:start + _MAX_CV_CHANNELS] = cv2.resize(
+            chunk, (img_size[1], img_size[0]), interpolation=cv2.INTER_LINEAR).reshape(tuple(img_size) + (-1,))
+    return np.clip(resized.transpose(2, 0, 1), 0, 1)
+
+
+def overlay_heatmaps(gradients, original_imgs):
+    heatmaps = _jet_lut()[np.uint8(255 * gradients)]
+    superimposed_imgs = heatmaps * 0.7 + np.asarray(original_imgs, dtype=np.float32) * 0.3
+    return superimposed_imgs.astype(np.uint8)
+
+
+def generate_saliency_maps(model, img_batch, class_indices, original_imgs=None, method=INPUT_GRADIENTS):
+    """Saliency overlays for a batch of preprocessed images.
+
+    `img_batch` is the `(N, H, W, 3)` batch as uint8 pixels or as model input
+    scaled to [0, 1], and `class_indices` holds the target class for each
+    image. `original_imgs` defaults to the input pixels.
+    """
+    return classify_and_explain(model, img_batch, class_indices, method=method).saliency_maps(original_imgs)
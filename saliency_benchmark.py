@@ -0,0 +1,118 @@
+"""Compare the saliency methods' latency and memory on CPU.
+
+    python saliency_benchmark.py --untrained
+    python saliency_benchmark.py --model cnn --batch-size 8 --runs 10 --json saliency.json
+
+Each method runs in its own process: the model is loaded, a batch of
+generated scans is explained `--warmup` + `--runs` times (taped forward,
+gradients, post-processing and overlay), and the process reports its
+latencies and peak resident memory. A baseline process that only loads the
+model and runs one compiled forward pass, as served, gives the memory the
+saliency pass adds on top.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from model_registry import MODELS
+
+BASELINE = 'baseline'
+
+
+def run_child(method, model_key, untrained, batch_size, warmup, runs):
+    # Runs in the measured process; prints one JSON line.
+    from inference_engine import make_forward
+    from model_registry import get_registry
+    from saliency import classify_and_explain
+
+    registry = get_registry()
+    spec = registry.spec(MODELS[model_key])
+    model = spec.builder() if untrained else registry.get(spec.name)
+    rng = np.random.default_rng(0)
+    img_batch = rng.integers(0, 256, (batch_size,) + tuple(spec.img_size) + (3,), dtype=np.uint8)
+
+    latencies = []
+    if method == BASELINE:
+        make_forward(model, spec.img_size)(img_batch)
+    else:
+        for i in range(warmup + runs):
+            start = time.perf_counter()
+            classify_and_explain(model, img_batch, method=method).saliency_maps()
+            if i >= warmup:
+                latencies.append(time.perf_counter() - start)
+    # ru_maxrss is in kilobytes on Linux.
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print(json.dumps({'latencies': latencies, 'peak_mb': peak_mb}))
+
+
+def measure(method, args):
+    command = [sys.executable, os.path.abspath(__file__), '--child', method, '--model', args.model,
+               '--batch-size', str(args.batch_size), '--warmup', str(args.warmup), '--runs', str(args.runs)]
+    if args.untrained:
+        command.append('--untrained')
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{method} benchmark failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def summarize(results):
+    baseline = results[BASELINE]['peak_mb']
+    summary = {}
+    for method, result in results.items():
+        if method == BASELINE:
+            continue
+        values = np.array(result['latencies']) * 1000.0
+        summary[method] = {
+            'mean_ms': float(values.mean()),
+            'p50_ms': float(np.percentile(values, 50)),
+            'p95_ms': float(np.percentile(values, 95)),
+            'peak_mb': result['peak_mb'],
+            'extra_mb': result['peak_mb'] - baseline,
+        }
+    return summary
+
+
+def print_summary(summary, model_name, batch_size, out=sys.stdout):
+    print(f"{model_name}, batch of {batch_size}", file=out)
+    print(f"{'method':<12}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'peak MB':>10}{'extra MB':>10}", file=out)
+    for method, row in summary.items():
+        print(f"{method:<12}{row['mean_ms']:>10.1f}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}"
+              f"{row['peak_mb']:>10.0f}{row['extra_mb']:>10.0f}", file=out)
+
+
+def main(argv=None):
+    from saliency import METHODS
+
+    parser = argparse.ArgumentParser(description="Compare saliency methods for latency and peak memory.")
+    parser.add_argument('--model', choices=sorted(MODELS), default='xception')
+    parser.add_argument('--untrained', action='store_true',
+                        help="Use randomly initialised weights (same cost, no weight file needed).")
+    parser.add_argument('--methods', nargs='+', choices=sorted(METHODS), default=list(METHODS))
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--json', default=None, help="Also write the summary to this file.")
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        run_child(args.child, args.model, args.untrained, args.batch_size, args.warmup, args.runs)
+        return
+
+    results = {method: measure(method, args) for method in [BASELINE] + args.methods}
+    summary = summarize(results)
+    print_summary(summary, MODELS[args.model], args.batch_size)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'model': MODELS[args.model], 'batch_size': args.batch_size, 'methods': summary}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""Preprocess labeled scans once into memory-mappable uint8 shards.
+
+    python shards.py --output /data/shards /content/Training /content/Testing
+
+Every scan is decoded once and stored at each model input size (299x299 for
+Xception, 224x224 for the CNN) in `.npy` shards of `--shard-size` images,
+next to an `index.json` holding the class names and each split's paths and
+labels. `ShardedSplit` maps the shards read-only, so any number of training
+or evaluation processes share one copy through the page cache.
+
+Layout: <output>/index.json, <output>/<split>/<H>x<W>-<n>.npy
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from dataset import iter_class_paths
+from preprocessing import decode_images
+
+DEFAULT_SHARD_SIZE = 1024
+INDEX = 'index.json'
+
+
+def shard_name(img_size, number):
+    return f'{img_size[0]}x{img_size[1]}-{number:05d}.npy'
+
+
+def _decode(path, img_sizes):
+    try:
+        return decode_images(path, img_sizes)
+    except Exception:
+        return None
+
+
+def write_split(directory, output, img_sizes, shard_size=DEFAULT_SHARD_SIZE, workers=None, log=sys.stderr):
+    """Decode every labeled scan under `directory` into shards in `output`.
+
+    Returns the split's index entry. Scans that fail to decode are skipped
+    and listed under 'skipped'.
+    """
+    os.makedirs(output, exist_ok=True)
+    items = [(path, label) for path, label in iter_class_paths(directory) if label]
+    paths, labels, skipped, shards = [], [], [], []
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for start in range(0, len(items), shard_size):
+            chunk = items[start:start + shard_size]
+            decoded = list(pool.map(lambda item: _decode(item[0], img_sizes), chunk))
+            kept = [(item, arrays) for item, arrays in zip(chunk, decoded) if arrays is not None]
+            skipped.extend(path for (path, _), arrays in zip(chunk, decoded) if arrays is None)
+            if not kept:
+                continue
+
+            number = len(shards)
+            for img_size in img_sizes:
+                name = shard_name(img_size, number)
+                # Written under a temporary name so an interrupted run never
+                # leaves a truncated shard behind.
+                tmp = os.path.join(output, name + '.tmp')
+                shard = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8,
+                                                  shape=(len(kept),) + tuple(img_size) + (3,))
+                for i, (_, arrays) in enumerate(kept):
+                    shard[i] = arrays[tuple(img_size)]
+                shard.flush()
+                del shard
+                os.replace(tmp, os.path.join(output, name))
+            shards.append(len(kept))
+            paths.extend(path for (path, _), _ in kept)
+            labels.extend(label for (_, label), _ in kept)
+            print(f"\r{directory}: {len(paths)}/{len(items)} scans", end='', file=log, flush=True)
+    print(file=log)
+    return {'paths': paths, 'labels': labels, 'shards': shards, 'skipped': skipped}
+
+
+def build(directories, output, img_sizes, shard_size=DEFAULT_SHARD_SIZE, workers=None):
+    img_sizes = [tuple(img_size) for img_size in img_sizes]
+    splits = {}
+    for directory in directories:
+        name = os.path.basename(os.path.normpath(directory))
+        splits[name] = write_split(directory, os.path.join(output, name), img_sizes, shard_size, workers)
+    classes = sorted({label for split in splits.values() for label in split['labels']})
+    index = {'classes': classes, 'img_sizes': [list(img_size) for img_size in img_sizes], 'splits': splits}
+    with open(os.path.join(output, INDEX + '.tmp'), 'w') as f:
+        json.dump(index, f)
+    os.replace(os.path.join(output, INDEX + '.tmp'), os.path.join(output, INDEX))
+    return index
+
+
+class ShardedSplit:
+    """One split of a shard directory at one image size, memory-mapped.
+
+    Indexing returns read-only views into the mapped shards, without
+    copying. `order(seed, epoch)` is a shuffled visiting order that depends
+    only on its arguments, so runs are reproducible.
+    """
+
+    def __init__(self, root, split, img_size):
+        with open(os.path.join(root, INDEX)) as f:
+            index = json.load(f)
+        entry = index['splits'][split]
+        self.classes = index['classes']
+        self.img_size = tuple(img_size)
+        self.paths = entry['paths']
+        self.labels = np.array([self.classes.index(label) for label in entry['labels']], dtype=np.int32)
+        self._shards = [np.load(os.path.join(root, split, shard_name(self.img_size, number)), mmap_mode='r')
+                        for number in range(len(entry['shards']))]
+        self._offsets = np.cumsum([0] + entry['shards'])
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def __getitem__(self, i):
+        shard = np.searchsorted(self._offsets, i, side='right') - 1
+        return self._shards[shard][i - self._offsets[shard]]
+
+    def order(self, seed=0, epoch=0):
+        return np.random.default_rng([seed, epoch]).permutation(len(self))
+
+    def images(self, indices=None):
+        # (image, label) pairs, in `indices` order or sequentially.
+        if indices is None:
+            for shard, start in zip(self._shards, self._offsets):
+                for offset, img in enumerate(shard):
+                    yield img, self.labels[start + offset]
+        else:
+            for i in indices:
+                yield self[i], self.labels[i]
+
+    def batches(self, batch_size, indices=None):
+        # Sequential batches are views of one shard where possible.
+        if indices is None:
+            for shard, start in zip(self._shards, self._offsets):
+                for offset in range(0, len(shard), batch_size):
+                    yield shard[offset:offset + batch_size], self.labels[start + offset:start + offset + batch_size]
+        else:
+            for start in range(0, len(indices), batch_size):
+                chunk = indices[start:start + batch_size]
+                yield np.stack([self[i] for i in chunk]), self.labels[chunk]
+
+
+def main(argv=None):
+    from model_registry import MODEL_SPECS
+
+    parser = argparse.ArgumentParser(description="Write labeled scans as memory-mappable uint8 shards.")
+    parser.add_argument('directories', nargs='+', help="Split directories, each laid out as <dir>/<label>/<image>.")
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=sorted({spec.img_size[0] for spec in MODEL_SPECS.values()}, reverse=True),
+                        help="Square image sizes to store (default: every model's input size).")
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE, help="Images per shard file.")
+    parser.add_argument('--workers', type=int, default=None, help="Parallel decode threads.")
+    args = parser.parse_args(argv)
+
+    index = build(args.directories, args.output, [(size, size) for size in args.sizes], args.shard_size, args.workers)
+    for name, split in index['splits'].items():
+        print(f"{name}: {len(split['paths'])} scans in {len(split['shards'])} shards, {len(split['skipped'])} skipped")
+
+
+if __name__ == '__main__':
+    main()
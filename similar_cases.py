@@ -0,0 +1,220 @@
+"""The labeled scans most similar to a new one, for the report.
+
+    python similar_cases.py --output similar_cases.npz /content/Training /content/Testing
+    python similar_cases.py --output similar_cases.npz --shards /data/shards Training Testing
+
+Builds a float16 index of the Xception base model's pooled features (its
+`pooling='max'` output) for every labeled scan. At serving time a scan's
+features are compared against the whole index with one matrix product,
+which takes milliseconds for a dataset of this size, so no approximate
+search structure is needed.
+"""
+import argparse
+import os
+import sys
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+import tensorflow as tf
+
+from dataset import iter_class_paths
+from metrics import METRICS
+from model_registry import XCEPTION, get_registry
+from preprocessing import decode_image, normalize
+
+DEFAULT_INDEX_PATH = os.getenv("SIMILAR_CASES_INDEX", "similar_cases.npz")
+DEFAULT_K = 3
+BATCH_SIZE = 32
+
+_embedders = weakref.WeakKeyDictionary()
+
+
+def _embedder(model):
+    # The Xception base is the Sequential model's first layer; its output is
+    # the max-pooled feature vector that feeds Flatten.
+    embed = _embedders.get(model)
+    if embed is None:
+        base = model.layers[0]
+        signature = [tf.TensorSpec(shape=(None,) + tuple(base.inputs[0].shape[1:]), dtype=tf.uint8)]
+        embed = _embedders[model] = tf.function(
+            lambda x: tf.math.l2_normalize(base(normalize(x), training=False), axis=-1), input_signature=signature)
+    return embed
+
+
+def embed(model, img_array):
+    """Unit-length Xception features for a `(n, 299, 299, 3)` uint8 batch."""
+    with METRICS.timer('similar_cases_seconds', phase='embed'):
+        return _embedder(model)(img_array).numpy()
+
+
+@dataclass(frozen=True)
+class SimilarCase:
+    label: str
+    path: str
+    similarity: float
+
+    def describe(self):
+        return f"{self.label}: labeled scan {os.path.basename(self.path)} ({self.similarity * 100:.1f}% similar)"
+
+
+class SimilarCaseIndex:
+    """Features, labels and paths of the labeled scans.
+
+    Stored as float16; a float32 copy is kept in memory so lookups go
+    through BLAS.
+    """
+
+    def __init__(self, features, labels, paths, model_id='', weights_sha256=''):
+        self.features = np.asarray(features, dtype=np.float16)
+        self.labels = np.asarray(labels, dtype=str)
+        self.paths = np.asarray(paths, dtype=str)
+        self.model_id = model_id
+        self.weights_sha256 = weights_sha256
+        self._matrix = self.features.astype(np.float32)
+
+    def __len__(self):
+        return len(self.features)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            # Indexes saved before the weight hash was recorded have none and
+            # never match.
+            weights_sha256 = str(data['weights_sha256']) if 'weights_sha256' in data.files else ''
+            return cls(data['features'], data['labels'], data['paths'], str(data['model_id']), weights_sha256)
+
+    def save(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, features=self.features, labels=self.labels, paths=self.paths, model_id=self.model_id,
+                     weights_sha256=self.weights_sha256)
+        os.replace(tmp, path)
+
+    def search(self, queries, k=DEFAULT_K):
+        # Top-k rows by cosine similarity for each of the `(n, d)` unit-length
+        # queries; returns `(n, k)` indices and similarities, best first.
+        with METRICS.timer('similar_cases_seconds', phase='search'):
+            scores = np.asarray(queries, dtype=np.float32) @ self._matrix.T
+            k = min(k, len(self))
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1)
+            return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    def similar(self, queries, k=DEFAULT_K):
+        indices, scores = self.search(queries, k)
+        return [[SimilarCase(str(self.labels[i]), str(self.paths[i]), float(score)) for i, score in zip(row, row_scores)]
+                for row, row_scores in zip(indices, scores)]
+
+
+_indexes = {}
+_stale = set()
+
+
+def get_index(path=DEFAULT_INDEX_PATH, registry=None):
+    """The index at `path`, loaded once per process, or None if there is none.
+
+    An index embedded by other Xception weights than the registry's current
+    ones (retrained, or swapped in with `ModelRegistry.swap`) is refused as
+    well: its neighbours would not be those of the served model. Weights are
+    compared by the SHA-256 of the file, so a copied or touched file still
+    matches.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    cached = _indexes.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = _indexes[path] = (mtime, SimilarCaseIndex.load(path))
+    index = cached[1]
+    registry = registry or get_registry()
+    weights_sha256 = registry.weights_sha256(XCEPTION)
+    if index.weights_sha256 != weights_sha256:
+        METRICS.inc('similar_cases_stale_index_total')
+        if (path, mtime, weights_sha256) not in _stale:
+            _stale.add((path, mtime, weights_sha256))
+            print(f"Ignoring {path}: built for {index.model_id!r}, serving {registry.model_id(XCEPTION)!r} "
+                  f"with other weights; rebuild it with similar_cases.py", file=sys.stderr)
+        return None
+    return index
+
+
+def find_similar_cases(img_array, k=DEFAULT_K, registry=None, index=None, sources=None):
+    """The k most similar labeled scans for each scan in a uint8 batch.
+
+    Scans are compared by Xception features. A batch decoded for another
+    model's input size is decoded again at Xception's from `sources`, the
+    scans' paths or files. Returns one list of `SimilarCase` per scan, empty
+    when no index has been built for the current Xception weights (nothing
+    is decoded or loaded then).
+    """
+    registry = registry or get_registry()
+    index = index or get_index(registry=registry)
+    if index is None or not len(index):
+        return [[] for _ in img_array]
+    img_size = tuple(registry.spec(XCEPTION).img_size)
+    if tuple(img_array.shape[1:3]) != img_size:
+        img_array = np.stack([decode_image(source, img_size) for source in sources])
+    return index.similar(embed(registry.get(XCEPTION), img_array), k)
+
+
+def _directory_batches(directories, img_size, batch_size, workers=None):
+    items = [(path, label) for directory in directories for path, label in iter_class_paths(directory) if label]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for start in range(0, len(items), batch_size):
+            chunk = items[start:start + batch_size]
+            images = list(pool.map(lambda item: decode_image(item[0], img_size), chunk))
+            yield np.stack(images), [label for _, label in chunk], [path for path, _ in chunk]
+
+
+def _shard_batches(root, splits, img_size, batch_size):
+    from shards import ShardedSplit
+
+    for split in splits:
+        sharded = ShardedSplit(root, split, img_size)
+        start = 0
+        for images, labels in sharded.batches(batch_size):
+            yield images, [sharded.classes[label] for label in labels], sharded.paths[start:start + len(images)]
+            start += len(images)
+
+
+def build_index(batches, registry=None, log=sys.stderr):
+    """Embed `(uint8 images, labels, paths)` batches into a SimilarCaseIndex."""
+    registry = registry or get_registry()
+    model = registry.get(XCEPTION)
+    features, labels, paths = [], [], []
+    for images, batch_labels, batch_paths in batches:
+        features.append(embed(model, images).astype(np.float16))
+        labels.extend(batch_labels)
+        paths.extend(batch_paths)
+        print(f"\r{len(paths)} scans embedded", end='', file=log, flush=True)
+    print(file=log)
+    dim = model.layers[0].outputs[0].shape[-1]
+    return SimilarCaseIndex(np.concatenate(features) if features else np.zeros((0, dim), np.float16),
+                            labels, paths, registry.model_id(XCEPTION), registry.weights_sha256(XCEPTION))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index labeled scans for the report's similar cases.")
+    parser.add_argument('sources', nargs='+',
+                        help="Directories laid out as <dir>/<label>/<image>, or split names with --shards.")
+    parser.add_argument('--output', default=DEFAULT_INDEX_PATH)
+    parser.add_argument('--shards', default=None, help="Read the splits from this shards.py directory.")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    img_size = get_registry().spec(XCEPTION).img_size
+    if args.shards:
+        batches = _shard_batches(args.shards, args.sources, img_size, args.batch_size)
+    else:
+        batches = _directory_batches(args.sources, img_size, args.batch_size)
+    index = build_index(batches)
+    index.save(args.output)
+    print(f"Wrote {len(index)} scans to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Cold-start benchmark for the Streamlit app.
+
+    python startup_benchmark.py
+    python startup_benchmark.py --runs 5 --json startup.json
+
+Every sample runs in a fresh interpreter, so nothing is imported yet:
+
+- import: cumulative import time (from `python -X importtime`) of what
+  app.py imports before drawing its shell, and of each heavy module it
+  defers until an upload, a report or a chat needs it.
+- first paint: time from launching the interpreter until app.py has drawn
+  its shell (title and uploader, nothing uploaded), run through Streamlit's
+  AppTest. The model warm-up it starts in the background is not waited for.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# What app.py imports at the top, i.e. before the first paint.
+SHELL_MODULES = ['streamlit', 'numpy', 'PIL.Image', 'llm_client', 'audit_store', 'metrics', 'result_cache']
+DEFERRED_MODULES = ['tensorflow', 'cv2', 'plotly.graph_objects', 'fpdf', 'google.generativeai', 'mistralai']
+
+FIRST_PAINT = """
+import sys, time
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file({path!r}, default_timeout={timeout}).run()
+painted = time.time()
+if at.exception:
+    sys.exit(str(at.exception))
+print(painted)
+"""
+
+
+def import_seconds(modules):
+    # Sum of the top-level cumulative times; None if a module is missing.
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + ', '.join(modules)],
+                            cwd=APP_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        if cumulative.strip().isdigit() and not name[1:].startswith(' '):
+            total += int(cumulative)
+    return total / 1e6
+
+
+def first_paint_seconds(timeout=60):
+    start = time.time()
+    result = subprocess.run([sys.executable, '-c', FIRST_PAINT.format(path=os.path.join(APP_DIR, 'app.py'),
+                                                                      timeout=timeout)],
+                            cwd=APP_DIR, capture_output=True, text=True, timeout=timeout * 2)
+    if result.returncode != 0:
+        return None
+    return float(result.stdout.strip().splitlines()[-1]) - start
+
+
+def summarize(samples):
+    summary = {}
+    for name, values in samples.items():
+        values = [value for value in values if value is not None]
+        if values:
+            values = np.array(values) * 1000.0
+            summary[name] = {'mean_ms': float(values.mean()), 'min_ms': float(values.min()),
+                             'max_ms': float(values.max())}
+        else:
+            summary[name] = None
+    return summary
+
+
+def print_summary(summary, runs, out=sys.stdout):
+    print(f"{runs} cold starts", file=out)
+    print(f"{'measure':<28}{'mean':>10}{'min':>10}{'max':>10}  (ms)", file=out)
+    for name, row in summary.items():
+        if row is None:
+            print(f"{name:<28}{'not available':>30}", file=out)
+        else:
+            print(f"{name:<28}{row['mean_ms']:>10.1f}{row['min_ms']:>10.1f}{row['max_ms']:>10.1f}", file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the app's import time and time to first paint.")
+    parser.add_argument('--runs', type=int, default=3, help="Cold starts per measurement.")
+    parser.add_argument('--timeout', type=int, default=60, help="Seconds to wait for the app script.")
+    parser.add_argument('--json', default=None, help="Also write the summary to this file.")
+    args = parser.parse_args(argv)
+
+    samples = {'import: app shell': [], **{f'import: {module}': [] for module in DEFERRED_MODULES},
+               'first paint': []}
+    for _ in range(args.runs):
+        samples['import: app shell'].append(import_seconds(SHELL_MODULES))
+        for module in DEFERRED_MODULES:
+            samples[f'import: {module}'].append(import_seconds([module]))
+        samples['first paint'].append(first_paint_seconds(args.timeout))
+
+    summary = summarize(samples)
+    print_summary(summary, args.runs)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'runs': args.runs, 'measures': summary}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
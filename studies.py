@@ -0,0 +1,309 @@
+"""Classify a multi-slice study: a DICOM series or a NIfTI volume.
+
+    python studies.py /data/study_dicom_dir --model xception --saliency-dir out/
+    python studies.py /data/brain.nii.gz --model cnn --top-k 5 --csv slices.csv
+
+Slices are read one at a time (DICOM files in anatomical order, NIfTI
+through nibabel's lazy array proxy), windowed to uint8, resized to the
+model's input size and classified in fixed-size batches, the next batch
+being read while the model works on the previous one. Only the per-slice
+probabilities and the k most suspicious slices are kept, so memory does not
+grow with the study. The study-level verdict is taken from those k slices,
+and saliency is computed for them alone.
+"""
+import argparse
+import csv
+import hashlib
+import heapq
+import os
+import tempfile
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+import numpy as np
+import PIL.Image
+
+from inference_engine import get_engine
+from metrics import METRICS
+from model_registry import LABELS, MODELS, get_registry
+from result_cache import image_digest
+from saliency import INPUT_GRADIENTS, METHODS, classify_and_explain
+
+NO_TUMOR = LABELS.index('No tumor')
+DEFAULT_BATCH_SIZE = 16
+DEFAULT_TOP_K = 3
+# A study is called a tumor when its top-k slices are, on average, more
+# likely tumor than not.
+TUMOR_THRESHOLD = 0.5
+NIFTI_EXTENSIONS = ('.nii', '.nii.gz')
+
+
+def window(pixels, center=None, width=None):
+    # Raw intensities to uint8 through the DICOM window when there is one,
+    # else through the slice's 1st-99th percentile range.
+    pixels = np.asarray(pixels, dtype=np.float32)
+    if center is None or width is None:
+        low, high = np.percentile(pixels, (1, 99))
+    else:
+        low, high = center - width / 2, center + width / 2
+    scale = 255.0 / (high - low) if high > low else 0.0
+    return np.clip((pixels - low) * scale, 0, 255).astype(np.uint8)
+
+
+def to_model_input(gray, img_size):
+    # A windowed slice as the (H, W, 3) uint8 RGB the models take, resized the
+    # way preprocessing.decode_image resizes the dataset's scans.
+    resized = PIL.Image.fromarray(gray).resize((img_size[1], img_size[0]), PIL.Image.NEAREST)
+    return np.repeat(np.asarray(resized)[..., np.newaxis], 3, axis=-1)
+
+
+def _name(f):
+    return os.path.basename(getattr(f, 'name', None) or str(f))
+
+
+def _first(value):
+    # Window tags may hold several windows; the first is the default one.
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple)) or type(value).__name__ == 'MultiValue':
+        value = value[0]
+    return float(value)
+
+
+def iter_dicom_slices(files):
+    """`(slice id, uint8 slice)` for a DICOM series, in anatomical order.
+
+    `files` are paths or file-like objects such as uploads. Only headers are
+    read to order the series; each slice's pixels are then read on their own.
+    """
+    import pydicom
+
+    order = []
+    for f in files:
+        header = pydicom.dcmread(f, stop_before_pixels=True)
+        position = getattr(header, 'ImagePositionPatient', None)
+        order.append((float(position[2]) if position else 0.0, int(getattr(header, 'InstanceNumber', 0) or 0), f))
+    for _, _, f in sorted(order, key=lambda item: item[:2]):
+        if hasattr(f, 'seek'):
+            f.seek(0)
+        ds = pydicom.dcmread(f)
+        pixels = ds.pixel_array.astype(np.float32)
+        pixels = pixels * float(getattr(ds, 'RescaleSlope', 1) or 1) + float(getattr(ds, 'RescaleIntercept', 0) or 0)
+        center, width = _first(getattr(ds, 'WindowCenter', None)), _first(getattr(ds, 'WindowWidth', None))
+        if pixels.ndim == 2:
+            yield _name(f), window(pixels, center, width)
+        else:
+            # Multi-frame files hold the whole series.
+            for frame_number, frame in enumerate(pixels):
+                yield f"{_name(f)}#{frame_number}", window(frame, center, width)
+
+
+def iter_nifti_slices(path, axis=2):
+    """`(slice id, uint8 slice)` along `axis` of a NIfTI volume.
+
+    The array proxy reads one slice at a time; keeping the file open lets a
+    gzipped volume be decompressed once, front to back, rather than from the
+    start for every slice. Slices are rotated so the anterior side is up, as
+    in the dataset's scans; of a 4D file only the first volume is used.
+    """
+    import nibabel as nib
+
+    img = nib.load(path, keep_file_open=True)
+    for k in range(img.shape[axis]):
+        index = [slice(None), slice(None), slice(None)] + [0] * (len(img.shape) - 3)
+        index[axis] = k
+        yield f"slice {k}", window(np.rot90(np.asarray(img.dataobj[tuple(index)], dtype=np.float32)))
+
+
+def iter_study_slices(files):
+    """Slices of one study: a NIfTI file, or the files or directory of a DICOM series.
+
+    Uploads (file-like objects) are accepted too; an uploaded NIfTI volume is
+    spooled to a temporary file so nibabel can still read it lazily.
+    """
+    files = list(files)
+    if len(files) == 1 and isinstance(files[0], str) and os.path.isdir(files[0]):
+        directory = files[0]
+        files = [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+                 if os.path.isfile(os.path.join(directory, name)) and not name.startswith('.')]
+    if len(files) == 1 and _name(files[0]).lower().endswith(NIFTI_EXTENSIONS):
+        f = files[0]
+        if isinstance(f, str):
+            yield from iter_nifti_slices(f)
+            return
+        suffix = '.nii.gz' if _name(f).lower().endswith('.gz') else '.nii'
+        with tempfile.NamedTemporaryFile(suffix=suffix) as tmp:
+            f.seek(0)
+            tmp.write(f.read())
+            tmp.flush()
+            yield from iter_nifti_slices(tmp.name)
+        return
+    yield from iter_dicom_slices(files)
+
+
+def suspicion(probabilities):
+    # How likely a slice shows any tumor.
+    return 1.0 - probabilities[..., NO_TUMOR]
+
+
+def study_verdict(probabilities, top_slices, threshold=TUMOR_THRESHOLD):
+    # (label, confidence) from the most suspicious slices. Averaging over the
+    # whole study would let the healthy slices outvote a tumor seen in a few.
+    top = probabilities[top_slices]
+    if suspicion(top).mean() < threshold:
+        return LABELS[NO_TUMOR], float(top[:, NO_TUMOR].mean())
+    means = top.mean(axis=0)
+    means[NO_TUMOR] = -1.0
+    class_index = int(np.argmax(means))
+    return LABELS[class_index], float(means[class_index])
+
+
+@dataclass
+class StudyResult:
+    slice_ids: List[str]
+    probabilities: np.ndarray
+    label: str
+    confidence: float
+    # Indices into slice_ids, most suspicious first, and their overlays.
+    top_slices: List[int]
+    saliency_maps: Dict[int, np.ndarray] = field(default_factory=dict)
+
+
+def _batches(slices, batch_size):
+    batch = []
+    for item in slices:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _completed(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def classify_study(slices, model_name, batch_size=DEFAULT_BATCH_SIZE, top_k=DEFAULT_TOP_K,
+                   saliency_method=INPUT_GRADIENTS, backend='keras', registry=None, audit=None, source=None):
+    """Classify `(slice id, uint8 slice)` pairs and summarize the study.
+
+    Saliency overlays explain the study's verdict on its `top_k` most
+    suspicious slices. With an `audit` store, every slice is recorded as a
+    classification of its own (see `record_study`).
+    """
+    registry = registry or get_registry()
+    img_size = registry.spec(model_name).img_size
+    if backend == 'tflite':
+        tflite_model = registry.get_tflite(model_name)
+        submit = lambda img_array: _completed(tflite_model.predict(img_array))
+    else:
+        submit = get_engine(model_name, registry).submit
+
+    slice_ids, digests, probabilities, top = [], [], [], []
+
+    def collect(pending):
+        future, ids, img_array = pending
+        probs = future.result()
+        for offset, (img, p) in enumerate(zip(img_array, probs)):
+            # The heap holds copies, so the batch itself can be freed.
+            item = (float(suspicion(p)), len(slice_ids) + offset, img.copy())
+            if len(top) < top_k:
+                heapq.heappush(top, item)
+            else:
+                heapq.heappushpop(top, item)
+        slice_ids.extend(ids)
+        probabilities.append(probs)
+
+    pending = None
+    start = time.perf_counter()
+    with METRICS.timer('study_seconds', phase='classify'):
+        for batch in _batches(slices, batch_size):
+            ids = [slice_id for slice_id, _ in batch]
+            if audit is not None:
+                digests.extend(image_digest(np.ascontiguousarray(gray).tobytes()) for _, gray in batch)
+            img_array = np.stack([to_model_input(gray, img_size) for _, gray in batch])
+            future = submit(img_array)
+            if pending is not None:
+                collect(pending)
+            pending = (future, ids, img_array)
+        if pending is not None:
+            collect(pending)
+    classify_seconds = time.perf_counter() - start
+    if not slice_ids:
+        raise ValueError("The study has no slices")
+    METRICS.inc('study_slices_total', len(slice_ids), model=model_name)
+
+    probabilities = np.concatenate(probabilities)
+    top = sorted(top, reverse=True)
+    top_slices = [index for _, index, _ in top]
+    label, confidence = study_verdict(probabilities, top_slices)
+
+    with METRICS.timer('study_seconds', phase='saliency'):
+        overlays = classify_and_explain(registry.get(model_name), np.stack([img for _, _, img in top]),
+                                        [LABELS.index(label)] * len(top), method=saliency_method).saliency_maps()
+    result = StudyResult(slice_ids, probabilities, label, confidence, top_slices, dict(zip(top_slices, overlays)))
+    if audit is not None:
+        record_study(audit, result, digests, model_name, registry.model_id(model_name, backend), backend,
+                     classify_seconds, saliency_method, source)
+    return result
+
+
+def record_study(audit, result, digests, model_name, model_version, backend, classify_seconds, saliency_method,
+                 source=None):
+    # One audit row per slice, keyed by the SHA-256 of its windowed pixels.
+    # The study's hash (of its slice hashes, in order) and verdict tie the
+    # rows together; the top slices, which got overlays, carry the method.
+    study_hash = hashlib.sha256(''.join(digests).encode()).hexdigest()
+    top_slices = set(result.top_slices)
+    for index, (slice_id, digest, probs) in enumerate(zip(result.slice_ids, digests, result.probabilities)):
+        audit.record(digest, model_name, probs, model_version=model_version,
+                     latencies={'forward': classify_seconds / len(result.slice_ids)},
+                     artifacts={'study': study_hash, 'slice': slice_id, 'verdict': result.label}, source=source,
+                     backend=backend, saliency_method=saliency_method if index in top_slices else None)
+
+
+def main(argv=None):
+    from audit_store import get_audit_store
+
+    parser = argparse.ArgumentParser(description="Classify a DICOM series or NIfTI volume slice by slice.")
+    parser.add_argument('sources', nargs='+', help="A NIfTI file, a DICOM series directory, or DICOM files.")
+    parser.add_argument('--model', choices=sorted(MODELS), default='xception')
+    parser.add_argument('--backend', choices=('keras', 'tflite'), default=os.getenv('INFERENCE_BACKEND', 'keras'))
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--top-k', type=int, default=DEFAULT_TOP_K, help="Slices that decide the verdict.")
+    parser.add_argument('--saliency-method', choices=sorted(METHODS), default=INPUT_GRADIENTS)
+    parser.add_argument('--saliency-dir', default=None, help="Write the top slices' saliency overlays here.")
+    parser.add_argument('--csv', default=None, help="Write per-slice probabilities to this CSV file.")
+    args = parser.parse_args(argv)
+
+    audit = get_audit_store()
+    result = classify_study(iter_study_slices(args.sources), MODELS[args.model], args.batch_size, args.top_k,
+                            args.saliency_method, args.backend, audit=audit, source='study')
+    if audit is not None:
+        audit.flush()
+    print(f"{len(result.slice_ids)} slices: {result.label} ({result.confidence * 100:.2f}%)")
+    for index in result.top_slices:
+        probs = result.probabilities[index]
+        print(f"  {result.slice_ids[index]}: {LABELS[int(np.argmax(probs))]}, "
+              f"tumor {suspicion(probs) * 100:.2f}%")
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['slice'] + [f'prob_{label}' for label in LABELS])
+            for slice_id, probs in zip(result.slice_ids, result.probabilities):
+                writer.writerow([slice_id] + [float(p) for p in probs])
+    if args.saliency_dir:
+        os.makedirs(args.saliency_dir, exist_ok=True)
+        for index, overlay in result.saliency_maps.items():
+            name = result.slice_ids[index].replace(os.sep, '_').replace(' ', '_').replace('#', '_')
+            PIL.Image.fromarray(overlay).save(os.path.join(args.saliency_dir, f"{index:04d}_{name}.png"))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+import numpy as np
+
+from saliency import postprocess_gradients, upsample_maps
+
+
+def test_postprocess_gradients_over_cv2_channel_limit():
+    # 129 images are blurred in two cv2 calls; each must match its own
+    # single-image result.
+    gradients = np.random.default_rng(0).random((129, 64, 64), dtype=np.float32)
+    batched = postprocess_gradients(gradients)
+    for i in (0, 127, 128):
+        np.testing.assert_array_equal(batched[i], postprocess_gradients(gradients[i:i + 1])[0])
+
+
+def test_upsample_maps_over_cv2_channel_limit():
+    maps = np.random.default_rng(0).random((129, 10, 10), dtype=np.float32)
+    batched = upsample_maps(maps, (299, 299))
+    assert batched.shape == (129, 299, 299)
+    for i in (0, 127, 128):
+        np.testing.assert_allclose(batched[i], upsample_maps(maps[i:i + 1], (299, 299))[0], atol=1e-6)
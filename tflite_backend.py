@@ -0,0 +1,171 @@
+"""TFLite export and runtime backend for CPU-only serving.
+
+    python tflite_backend.py --model xception --quantization int8 --calibration-dir /data/Training
+    python tflite_backend.py --model cnn --quantization dynamic --parity-dir /data/Testing
+
+Exports the registry's Keras model to `<weight file>.tflite` (or --output),
+optionally calibrating full-integer quantization on a sample of scans, and
+checks the exported model's probabilities against the Keras model's. The app
+and batch CLI use the exported file when INFERENCE_BACKEND=tflite.
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from dataset import iter_class_paths
+from metrics import METRICS
+from preprocessing import load_image_array, normalize
+
+QUANTIZATIONS = ('none', 'float16', 'dynamic', 'int8')
+
+
+def _interpreter_class():
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+def tflite_path(weights_path):
+    return os.path.splitext(weights_path)[0] + '.tflite'
+
+
+def sample_images(directory, img_size, count):
+    def decodable():
+        for path, _ in iter_class_paths(directory):
+            try:
+                yield load_image_array(path, img_size)
+            except Exception:
+                continue
+
+    return itertools.islice(decodable(), count)
+
+
+def export(model, img_size, output_path, quantization='dynamic', calibration_dir=None, num_calibration=200):
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'dynamic':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif quantization == 'int8':
+        if not calibration_dir:
+            raise ValueError("int8 quantization needs calibration images (calibration_dir)")
+
+        def representative_dataset():
+            for img_array in sample_images(calibration_dir, img_size, num_calibration):
+                yield [img_array[np.newaxis]]
+
+        # Weights and activations are int8; inputs and outputs stay float32 so
+        # the exported model is a drop-in replacement.
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif quantization != 'none':
+        raise ValueError(f"Unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}")
+
+    tflite_model = converter.convert()
+    with open(output_path, 'wb') as f:
+        f.write(tflite_model)
+    return output_path
+
+
+class TFLiteModel:
+    """A TFLite interpreter with the same `predict` contract as the Keras model.
+
+    The interpreter is not thread-safe, so calls are serialized; run one
+    instance per worker for parallelism.
+    """
+
+    def __init__(self, path, num_threads=None):
+        self.path = path
+        self._interpreter = _interpreter_class()(model_path=path, num_threads=num_threads)
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        self._batch_size = None
+        self._lock = threading.Lock()
+
+    def predict(self, img_array, verbose=0):
+        img_array = np.asarray(img_array)
+        if img_array.dtype == np.uint8:
+            img_array = normalize(img_array).numpy()
+        img_array = np.asarray(img_array, dtype=np.float32)
+        with self._lock, METRICS.timer('predict_seconds', path='tflite'):
+            if img_array.shape[0] != self._batch_size:
+                self._interpreter.resize_tensor_input(self._input['index'], img_array.shape)
+                self._interpreter.allocate_tensors()
+                self._batch_size = img_array.shape[0]
+            self._interpreter.set_tensor(self._input['index'], img_array)
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._output['index']).copy()
+
+
+def parity_check(keras_model, tflite_model, img_arrays, batch_size=16):
+    keras_probs, tflite_probs = [], []
+    keras_seconds = tflite_seconds = 0.0
+    for start in range(0, len(img_arrays), batch_size):
+        batch = np.stack(img_arrays[start:start + batch_size])
+        started = time.perf_counter()
+        keras_probs.append(keras_model(batch, training=False).numpy())
+        keras_seconds += time.perf_counter() - started
+        started = time.perf_counter()
+        tflite_probs.append(tflite_model.predict(batch))
+        tflite_seconds += time.perf_counter() - started
+    keras_probs = np.concatenate(keras_probs)
+    tflite_probs = np.concatenate(tflite_probs)
+
+    diff = np.abs(keras_probs - tflite_probs)
+    return {
+        'images': len(keras_probs),
+        'max_abs_diff': float(diff.max()),
+        'mean_abs_diff': float(diff.mean()),
+        'top1_agreement': float(np.mean(keras_probs.argmax(axis=1) == tflite_probs.argmax(axis=1))),
+        'keras_ms_per_image': 1000.0 * keras_seconds / len(keras_probs),
+        'tflite_ms_per_image': 1000.0 * tflite_seconds / len(keras_probs),
+    }
+
+
+def main(argv=None):
+    from model_registry import MODELS, get_registry
+
+    parser = argparse.ArgumentParser(description="Export a model to TFLite and check it against Keras.")
+    parser.add_argument('--model', choices=sorted(MODELS), default='xception')
+    parser.add_argument('--quantization', choices=QUANTIZATIONS, default='dynamic')
+    parser.add_argument('--output', default=None, help="Output file (default: next to the weight file).")
+    parser.add_argument('--calibration-dir', default=None, help="Scans used to calibrate int8 quantization.")
+    parser.add_argument('--num-calibration', type=int, default=200)
+    parser.add_argument('--parity-dir', default=None,
+                        help="Scans to compare Keras and TFLite probabilities on (default: calibration dir).")
+    parser.add_argument('--num-parity', type=int, default=200)
+    parser.add_argument('--min-top1-agreement', type=float, default=None,
+                        help="Exit non-zero if top-1 agreement with Keras falls below this.")
+    args = parser.parse_args(argv)
+
+    registry = get_registry()
+    name = MODELS[args.model]
+    spec = registry.spec(name)
+    model = registry.get(name)
+    output = args.output or tflite_path(spec.path)
+
+    export(model, spec.img_size, output, args.quantization, args.calibration_dir, args.num_calibration)
+    print(f"Wrote {output} ({os.path.getsize(output) / 1e6:.1f} MB, {args.quantization})")
+
+    parity_dir = args.parity_dir or args.calibration_dir
+    if parity_dir:
+        img_arrays = list(sample_images(parity_dir, spec.img_size, args.num_parity))
+        report = parity_check(model, TFLiteModel(output), img_arrays)
+        print(json.dumps(report, indent=2))
+        if args.min_top1_agreement is not None and report['top1_agreement'] < args.min_top1_agreement:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
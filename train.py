@@ -0,0 +1,243 @@
+"""Train the Xception or custom CNN classifier with a tf.data input pipeline.
+
+    python train.py --model xception --train-dir /content/Training --test-dir /content/Testing
+    python train.py --model cnn --train-dir /content/Training --test-dir /content/Testing --cache-dir /tmp/cache
+    python train.py --model xception --shards /data/shards
+
+Follows the notebook's recipe (same split of the Testing set into validation
+and test halves, batch sizes, epochs, optimizer and brightness augmentation)
+but decodes scans in parallel in the tf.data pipeline, caches the decoded, resized
+images to local files after the first epoch, augments on-graph, prefetches,
+and uses mixed precision on GPUs. With `--shards` it reads the memory-mapped
+uint8 shards written by shards.py instead of decoding anything. Writes the same weight files the app loads
+and prints images per second for every epoch.
+"""
+import argparse
+import hashlib
+import itertools
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tensorflow.keras.callbacks import Callback, EarlyStopping
+from tensorflow.keras.metrics import Precision, Recall
+from tensorflow.keras.optimizers import Adamax
+
+from dataset import get_class_paths
+from model_registry import CUSTOM_CNN, MODELS, XCEPTION, build_cnn_model, build_xception_model, get_registry
+from preprocessing import decode_image
+from shards import ShardedSplit
+
+# The notebook's settings for each model.
+RECIPES = {
+    XCEPTION: dict(build=lambda: build_xception_model(base_weights='imagenet'),
+                   epochs=5, batch_size=32, learning_rate=0.001, early_stopping=False),
+    CUSTOM_CNN: dict(build=build_cnn_model, epochs=8, batch_size=16, learning_rate=0.001, early_stopping=True),
+}
+
+BRIGHTNESS_RANGE = (0.8, 1.2)
+TEST_BATCH_SIZE = 16
+
+
+def split_stratified(df, fraction, seed=0):
+    # Like sklearn's train_test_split(train_size=fraction, stratify=Class):
+    # `fraction` of every class goes to the first frame.
+    rng = np.random.default_rng(seed)
+    first = []
+    for _, group in df.groupby('Class'):
+        index = group.index.to_numpy()
+        first.extend(rng.permutation(index)[:int(round(len(index) * fraction))])
+    first_df = df.loc[sorted(first)]
+    return first_df, df.drop(first_df.index)
+
+
+def _decode(path, img_size):
+    # Decoded by preprocessing.decode_image itself, as batch_classify does:
+    # TF's JPEG decoder uses an inexact DCT and would train the models on
+    # pixels slightly different from those the app serves them.
+    img = tf.numpy_function(lambda path: decode_image(path.decode(), img_size), [path], tf.uint8)
+    img.set_shape(tuple(img_size) + (3,))
+    return img
+
+
+def _augment(img):
+    # ImageDataGenerator's brightness_range: scale each image by a random
+    # factor, clipped to the valid pixel range.
+    factor = tf.random.uniform((), *BRIGHTNESS_RANGE)
+    return tf.clip_by_value(tf.cast(img, tf.float32) * factor, 0.0, 255.0)
+
+
+def make_dataset(df, classes, img_size, batch_size, training=False, cache_dir=None, seed=0):
+    """A batched `(images, one-hot labels)` dataset over a get_class_paths frame.
+
+    Decoded, resized uint8 images are cached after the first pass, in
+    `cache_dir` when given (keyed by the file list and size) or in memory.
+    Training data is reshuffled every epoch and augmented on-graph.
+    """
+    paths = df['Class Path'].tolist()
+    labels = tf.one_hot([classes.index(label) for label in df['Class']], len(classes))
+
+    ds = tf.data.Dataset.from_tensor_slices((paths, labels))
+    ds = ds.map(lambda path, label: (_decode(path, img_size), label), num_parallel_calls=tf.data.AUTOTUNE)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        fingerprint = hashlib.sha256('\n'.join(paths).encode()).hexdigest()[:16]
+        ds = ds.cache(os.path.join(cache_dir, f'{fingerprint}-{img_size[0]}x{img_size[1]}'))
+    else:
+        ds = ds.cache()
+    if training:
+        ds = ds.shuffle(len(paths), seed=seed, reshuffle_each_iteration=True)
+    return _finish(ds, batch_size, training)
+
+
+def make_shard_dataset(split, indices, batch_size, training=False, seed=0):
+    """Like `make_dataset`, over the rows `indices` of a `shards.ShardedSplit`.
+
+    Images come straight from the mapped shards. Training data is visited
+    in `split.order(seed, epoch)` order, so every run shuffles the same way.
+    """
+    indices = np.asarray(indices)
+    selected = np.zeros(len(split), dtype=bool)
+    selected[indices] = True
+    epochs = itertools.count()
+
+    def images():
+        order = split.order(seed, next(epochs)) if training else indices
+        yield from split.images(order[selected[order]] if training else order)
+
+    ds = tf.data.Dataset.from_generator(images, output_signature=(
+        tf.TensorSpec(split.img_size + (3,), tf.uint8), tf.TensorSpec((), tf.int32)))
+    ds = ds.apply(tf.data.experimental.assert_cardinality(len(indices)))
+    ds = ds.map(lambda img, label: (img, tf.one_hot(label, len(split.classes))))
+    return _finish(ds, batch_size, training)
+
+
+def _finish(ds, batch_size, training):
+    if training:
+        ds = ds.map(lambda img, label: (_augment(img), label), num_parallel_calls=tf.data.AUTOTUNE)
+    ds = ds.batch(batch_size)
+    ds = ds.map(lambda img, label: (tf.cast(img, tf.float32) / 255.0, label), num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+
+class Throughput(Callback):
+    """Logs training images per second for every epoch.
+
+    Only the training batches are timed; the validation pass at the end of
+    the epoch is not.
+    """
+
+    def __init__(self, num_images):
+        super().__init__()
+        self.num_images = num_images
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._seconds = 0.0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._seconds += time.perf_counter() - self._start
+
+    def on_epoch_end(self, epoch, logs=None):
+        images_per_second = self.num_images / self._seconds
+        if logs is not None:
+            logs['images_per_second'] = images_per_second
+        print(f"Epoch {epoch + 1}: {images_per_second:.1f} images/s")
+
+
+def train(model_name, train_dir, test_dir, output=None, epochs=None, batch_size=None, cache_dir=None,
+          mixed_precision=None, seed=0, shards=None):
+    """Train `model_name` and write its weights.
+
+    `train_dir` and `test_dir` are scan directories, or split names in the
+    `shards` directory when one is given.
+    """
+    recipe = RECIPES[model_name]
+    spec = get_registry().spec(model_name)
+    epochs = epochs or recipe['epochs']
+    batch_size = batch_size or recipe['batch_size']
+    output = output or spec.path
+    if mixed_precision is None:
+        mixed_precision = bool(tf.config.list_physical_devices('GPU'))
+
+    if shards:
+        tr_split = ShardedSplit(shards, train_dir, spec.img_size)
+        ts_split = ShardedSplit(shards, test_dir, spec.img_size)
+        tr_df = pd.DataFrame({'Class Path': tr_split.paths})
+        valid_df, ts_df = split_stratified(pd.DataFrame({'Class': ts_split.labels}), 0.5, seed)
+
+        tr_ds = make_shard_dataset(tr_split, np.arange(len(tr_split)), batch_size, training=True, seed=seed)
+        valid_ds = make_shard_dataset(ts_split, valid_df.index, batch_size)
+        ts_ds = make_shard_dataset(ts_split, ts_df.index, TEST_BATCH_SIZE)
+    else:
+        tr_df = get_class_paths(train_dir)
+        valid_df, ts_df = split_stratified(get_class_paths(test_dir), 0.5, seed)
+        classes = sorted(tr_df['Class'].unique())
+
+        tr_ds = make_dataset(tr_df, classes, spec.img_size, batch_size, training=True, cache_dir=cache_dir, seed=seed)
+        valid_ds = make_dataset(valid_df, classes, spec.img_size, batch_size, cache_dir=cache_dir)
+        ts_ds = make_dataset(ts_df, classes, spec.img_size, TEST_BATCH_SIZE, cache_dir=cache_dir)
+
+    tf.keras.mixed_precision.set_global_policy('mixed_float16' if mixed_precision else 'float32')
+    try:
+        model = recipe['build']()
+        model.compile(Adamax(learning_rate=recipe['learning_rate']),
+                      loss='categorical_crossentropy',
+                      metrics=['accuracy', Precision(name='precision'), Recall(name='recall')])
+        callbacks = [Throughput(len(tr_df))]
+        if recipe['early_stopping']:
+            callbacks.append(EarlyStopping(monitor='val_loss', patience=5, restore_best_weights=True))
+        history = model.fit(tr_ds, epochs=epochs, validation_data=valid_ds, callbacks=callbacks)
+
+        for split, ds in (('Train', tr_ds), ('Validation', valid_ds), ('Test', ts_ds)):
+            loss, accuracy = model.evaluate(ds, verbose=0)[:2]
+            print(f"{split} Accuracy: {accuracy * 100:.2f}%  Loss: {loss:.4f}")
+    finally:
+        tf.keras.mixed_precision.set_global_policy('float32')
+
+    # The app loads float32 models: copy the trained weights into one before
+    # saving, in the format each loader expects.
+    export = spec.builder() if mixed_precision else model
+    if export is not model:
+        export.set_weights(model.get_weights())
+    if model_name == XCEPTION:
+        export.save_weights(output)
+    else:
+        export.save(output)
+    print(f"Wrote {output}")
+    return history
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train a brain tumor classifier.")
+    parser.add_argument('--model', choices=sorted(MODELS), default='xception')
+    parser.add_argument('--train-dir', default=None, help="Training scans, laid out as <dir>/<label>/<image>.")
+    parser.add_argument('--test-dir', default=None, help="Testing scans, split into validation and test halves.")
+    parser.add_argument('--shards', default=None,
+                        help="Read preprocessed shards from this directory (see shards.py); --train-dir and "
+                             "--test-dir then name its splits (default: Training and Testing).")
+    parser.add_argument('--output', default=None, help="Weight file to write (default: the one the app loads).")
+    parser.add_argument('--epochs', type=int, default=None)
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--cache-dir', default=None,
+                        help="Cache decoded images here instead of in memory (reused across runs).")
+    parser.add_argument('--mixed-precision', action=argparse.BooleanOptionalAction, default=None,
+                        help="Train in mixed float16 (default: on when a GPU is available).")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    if args.shards:
+        args.train_dir = args.train_dir or 'Training'
+        args.test_dir = args.test_dir or 'Testing'
+    elif not (args.train_dir and args.test_dir):
+        parser.error("--train-dir and --test-dir are required without --shards")
+
+    train(MODELS[args.model], args.train_dir, args.test_dir, args.output, args.epochs, args.batch_size,
+          args.cache_dir, args.mixed_precision, args.seed, args.shards)
+
+
+if __name__ == '__main__':
+    main()